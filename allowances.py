@@ -0,0 +1,119 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+"""
+
+import clients
+import collections
+import logging
+import os
+import threading
+import time
+
+_logger = logging.getLogger()
+_logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
+
+# In-memory copy of the Allowances table, keyed by (namespace, service_account) with the DynamoDB item as value.
+# Reloaded with a full (paginated) scan once older than ALLOWANCES_MAX_STALENESS and patched in between from the
+# table's stream.
+_items = {}
+_namespaces = collections.Counter()
+_loaded_at = None
+_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    return float(os.getenv('ALLOWANCES_MAX_STALENESS', 60)) > 0
+
+
+def _key(item: dict) -> tuple:
+    return item['namespace']['S'], item['service_account']['S']
+
+
+def _put(items: dict, namespaces: collections.Counter, item: dict) -> None:
+    key = _key(item)
+    if key not in items:
+        namespaces[key[0]] += 1
+    items[key] = item
+
+
+def _remove(items: dict, namespaces: collections.Counter, key: tuple) -> None:
+    if items.pop(key, None) is not None:
+        namespaces[key[0]] -= 1
+        if namespaces[key[0]] <= 0:
+            del namespaces[key[0]]
+
+
+def _load() -> None:
+    """Scans the table into a new index, swapped in whole so concurrent lookups never see a partial load."""
+    global _items, _namespaces, _loaded_at
+    items = {}
+    namespaces = collections.Counter()
+    paginator = clients.get_client('dynamodb').get_paginator('scan')
+    for page in paginator.paginate(TableName=os.getenv('MAP_TABLE', 'mapped_roles')):
+        for item in page['Items']:
+            _put(items, namespaces, item)
+    _items, _namespaces, _loaded_at = items, namespaces, time.monotonic()
+    _logger.debug('Loaded %d allowances across %d namespaces', len(items), len(namespaces))
+
+
+def _ensure_fresh() -> None:
+    with _lock:
+        if _loaded_at is None or time.monotonic() - _loaded_at > float(os.getenv('ALLOWANCES_MAX_STALENESS', 60)):
+            _load()
+
+
+def get_allowance(namespace: str, service_account: str) -> dict:
+    """Returns the Allowances item for the service account, or None when there is not one."""
+    _ensure_fresh()
+    return _items.get((namespace, service_account))
+
+
+def get_allowed_arns(namespace: str, service_account: str) -> []:
+    item = get_allowance(namespace, service_account)
+    if item is not None and 'allowed_roles' in item:
+        return item['allowed_roles']['SS']
+    return None
+
+
+def namespace_has_allowances(namespace: str) -> bool:
+    _ensure_fresh()
+    return namespace in _namespaces
+
+
+def loaded_namespace_has_allowances(namespace: str) -> bool:
+    """Like namespace_has_allowances() but never loads: None when the index is not loaded or is stale."""
+    loaded_at = _loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at > float(os.getenv('ALLOWANCES_MAX_STALENESS', 60)):
+        return None
+    return namespace in _namespaces
+
+
+def invalidate() -> None:
+    """Forces a full reload on the next lookup."""
+    global _loaded_at
+    with _lock:
+        _loaded_at = None
+
+
+def is_allowances_record(record: dict) -> bool:
+    """Identifies DynamoDB stream records coming from the Allowances table (rather than Authorizations)."""
+    table = os.getenv('MAP_TABLE', 'mapped_roles')
+    return ':table/' + table + '/stream/' in record.get('eventSourceARN', '')
+
+
+def apply_stream_record(record: dict) -> None:
+    """Applies an INSERT/MODIFY/REMOVE from the Allowances stream to the loaded index."""
+    with _lock:
+        if _loaded_at is None:
+            return
+        if record['eventName'] == 'REMOVE':
+            _remove(_items, _namespaces, _key(record['dynamodb']['Keys']))
+        else:
+            _put(_items, _namespaces, record['dynamodb']['NewImage'])
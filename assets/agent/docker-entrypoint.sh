@@ -0,0 +1,14 @@
+#!/usr/bin/env sh
+set -eu
+
+export AGENT_PORT="${AGENT_PORT:-53080}"
+envsubst '${OCP_BROKER_LOC} ${AGENT_PORT}' < /etc/nginx/nginx.conf.TEMPLATE > /etc/nginx/nginx.conf
+
+# Optionally answer on a link-local address the AWS SDKs accept over plain http (e.g. 169.254.170.2:80) by
+# redirecting it to the agent on this node. Needs hostNetwork & NET_ADMIN.
+if [ -n "${AGENT_REDIRECT_ADDRESS:-}" ]; then
+    rule="PREROUTING -d ${AGENT_REDIRECT_ADDRESS} -p tcp --dport 80 -j DNAT --to-destination ${NODE_IP}:${AGENT_PORT}"
+    iptables -t nat -C ${rule} 2>/dev/null || iptables -t nat -A ${rule}
+fi
+
+exec "$@"
@@ -0,0 +1,76 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Microbenchmark of admission patch generation: the original deepcopy + JsonPatch.from_diff approach against the
+  direct webhook._build_patch builder, for pods with 1, 10 and 50 containers.
+
+      $ python benchmarks/bench_patch.py
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jsonpatch  # noqa: E402
+import webhook  # noqa: E402
+
+
+def _pod(containers: int, env_vars: int = 40) -> dict:
+    def container(index):
+        spec = {
+            'name': 'app-%d' % index,
+            'image': 'quay.io/cuppett/aws-cli',
+            'command': ['aws'],
+            'args': ['s3', 'ls'],
+            'resources': {'requests': {'cpu': '10m', 'memory': '64Mi'}},
+            'volumeMounts': [{'name': 'default-token', 'mountPath': '/var/run/secrets/kubernetes.io/serviceaccount'}]
+        }
+        # Every other container starts without an env list
+        if index % 2 == 0:
+            spec['env'] = [{'name': 'VAR_%d' % n, 'value': 'x' * 64} for n in range(env_vars)]
+        return spec
+
+    return {
+        'kind': 'Pod',
+        'apiVersion': 'v1',
+        'metadata': {'name': 'bench', 'namespace': 'bench', 'labels': {'app': 'bench'}},
+        'spec': {
+            'initContainers': [container(index) for index in range(2)],
+            'containers': [container(index) for index in range(containers)],
+            'serviceAccountName': 'default'
+        }
+    }
+
+
+def _diff(pod: dict) -> str:
+    return jsonpatch.JsonPatch.from_diff(pod, webhook._update_pod_spec(pod, 'bench-secret')).to_string()
+
+
+def _direct(pod: dict) -> str:
+    return json.dumps(webhook._build_patch(pod, 'bench-secret'))
+
+
+def main(repeat: int = 5) -> None:
+    print('%-12s %16s %16s %10s' % ('containers', 'diff (us/op)', 'direct (us/op)', 'speedup'))
+    for containers in (1, 10, 50):
+        pod = _pod(containers)
+        assert jsonpatch.apply_patch(pod, json.loads(_direct(pod))) == webhook._update_pod_spec(pod, 'bench-secret')
+
+        number = max(10, 2000 // containers)
+        diff = min(timeit.repeat(lambda: _diff(pod), number=number, repeat=repeat)) / number * 1e6
+        direct = min(timeit.repeat(lambda: _direct(pod), number=number, repeat=repeat)) / number * 1e6
+        print('%-12d %16.1f %16.1f %9.1fx' % (containers, diff, direct, diff / direct))
+
+
+if __name__ == '__main__':
+    main()
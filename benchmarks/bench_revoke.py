@@ -0,0 +1,104 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Revoking one namespace's authorizations from Authorizations tables of growing size: the index Query made by
+  revoke.py against a filtered Scan of the whole table. Reports the DynamoDB calls and rows read (what is billed) for
+  finding the tokens, plus the batch deletes. The fakes filter in memory, so wall time is not reported.
+
+      $ python benchmarks/bench_revoke.py --rows 1000 --rows 100000 --matching 50
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakes  # noqa: E402
+import revoke  # noqa: E402
+
+
+def _fill(dynamo: fakes.FakeDynamoDB, rows: int, matching: int) -> None:
+    table = dynamo.tables[os.getenv('AUTH_TABLE', 'role_perms')]
+    for index in range(rows):
+        namespace = 'target' if index < matching else 'app-%d' % (index % 500)
+        table[('token-%d' % index,)] = {
+            'auth_token': {'S': 'token-%d' % index},
+            'namespace': {'S': namespace},
+            'service_account': {'S': 'default'},
+            'role_arn': {'S': 'arn:aws:iam::123456789012:role/bench'},
+            'secret_name': {'S': 'broker-authorization-%d' % index}
+        }
+
+
+def _scan(dynamo: fakes.FakeDynamoDB, namespace: str) -> ([], int):
+    """The index-less alternative: every row is read and then filtered on the namespace."""
+    auth_tokens = []
+    read = 0
+    for page in dynamo.get_paginator('scan').paginate(TableName=os.getenv('AUTH_TABLE', 'role_perms')):
+        read += len(page['Items'])
+        auth_tokens.extend(item['auth_token']['S'] for item in page['Items'] if item['namespace']['S'] == namespace)
+    return auth_tokens, read
+
+
+def measure(rows: int, matching: int) -> dict:
+    backends = fakes.Backends()
+    with fakes.installed(backends) as environment:
+        dynamo = environment['dynamodb']
+        _fill(dynamo, rows, matching)
+
+        auth_tokens, scan_read = _scan(dynamo, 'target')
+        scan_calls = backends.calls['dynamodb.scan']
+        assert len(auth_tokens) == matching
+
+        backends.reset()
+        auth_tokens = revoke._query_authorizations(revoke._query_arguments('target', None, None))
+        query_calls = backends.calls['dynamodb.query']
+        assert len(auth_tokens) == matching
+
+        backends.reset()
+        summary = revoke.revoke(namespace='target')
+        assert summary['failed_authorizations'] == 0
+        assert len(dynamo.tables[os.getenv('AUTH_TABLE', 'role_perms')]) == rows - matching
+
+    return {
+        'rows': rows,
+        'matching': matching,
+        'scan_calls': scan_calls,
+        'scan_rows_read': scan_read,
+        'query_calls': query_calls,
+        'query_rows_read': len(auth_tokens),
+        'batch_write_calls': backends.calls['dynamodb.batch_write_item']
+    }
+
+
+def main(argv: [] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, action='append', metavar='ROWS',
+                        help='Authorizations table size (repeatable)')
+    parser.add_argument('--matching', type=int, default=50, help='Rows in the revoked namespace')
+    parser.add_argument('--json', action='store_true', help='Print one JSON document per table size')
+    args = parser.parse_args(argv)
+
+    for rows in args.rows or [1000, 10000, 100000]:
+        result = measure(rows, min(args.matching, rows))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('rows=%-8d matching=%-5d scan: %4d calls %8d read   query: %3d calls %6d read   batch writes: %d' % (
+                result['rows'], result['matching'], result['scan_calls'], result['scan_rows_read'],
+                result['query_calls'], result['query_rows_read'], result['batch_write_calls']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
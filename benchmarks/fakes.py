@@ -0,0 +1,251 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  In-process stand-ins for DynamoDB, STS, SSM and the Kubernetes API used by the benchmarks. Each one counts its calls
+  and sleeps for a configurable latency to model the network round trip.
+"""
+
+import base64
+import collections
+import contextlib
+import datetime
+import os
+import threading
+import time
+import uuid
+
+from botocore.exceptions import ClientError
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+_KUBECONFIG = """
+apiVersion: v1
+kind: Config
+clusters:
+- name: bench
+  cluster:
+    server: https://127.0.0.1:6443
+    insecure-skip-tls-verify: true
+contexts:
+- name: bench
+  context:
+    cluster: bench
+    user: bench
+current-context: bench
+users:
+- name: bench
+  user:
+    token: bench
+"""
+
+
+class Backends:
+    """Shared call counters & latencies (in seconds) for every fake backend."""
+
+    def __init__(self, latency: dict = None):
+        self.latency = collections.defaultdict(float, latency or {})
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+
+    def call(self, backend: str, operation: str) -> None:
+        with self._lock:
+            self.calls[backend + '.' + operation] += 1
+        if self.latency[backend] > 0:
+            time.sleep(self.latency[backend])
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+
+
+def _client_error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeDynamoDB:
+
+    def __init__(self, backends: Backends):
+        self.backends = backends
+        self.keys = {
+            os.getenv('AUTH_TABLE', 'role_perms'): ('auth_token',),
+            os.getenv('MAP_TABLE', 'mapped_roles'): ('namespace', 'service_account')
+        }
+        self.tables = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def _key(self, table: str, key: dict) -> tuple:
+        return tuple(key[name]['S'] for name in self.keys[table])
+
+    def get_item(self, TableName, Key, **kwargs):
+        self.backends.call('dynamodb', 'get_item')
+        item = self.tables[TableName].get(self._key(TableName, Key))
+        return {} if item is None else {'Item': dict(item)}
+
+    def put_item(self, TableName, Item, **kwargs):
+        self.backends.call('dynamodb', 'put_item')
+        with self._lock:
+            self.tables[TableName][self._key(TableName, Item)] = dict(Item)
+        return {}
+
+    def update_item(self, TableName, Key, ExpressionAttributeValues, **kwargs):
+        self.backends.call('dynamodb', 'update_item')
+        with self._lock:
+            item = self.tables[TableName].get(self._key(TableName, Key))
+            if item is None and 'ConditionExpression' in kwargs:
+                raise _client_error('ConditionalCheckFailedException', 'UpdateItem')
+            if item is not None:
+                item['expires'] = ExpressionAttributeValues[':e']
+                if ':l' in ExpressionAttributeValues:
+                    item['last_accessed'] = ExpressionAttributeValues[':l']
+        return {}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self.backends.call('dynamodb', 'delete_item')
+        with self._lock:
+            self.tables[TableName].pop(self._key(TableName, Key), None)
+        return {}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        self.backends.call('dynamodb', 'batch_write_item')
+        with self._lock:
+            for table, requests in RequestItems.items():
+                for request in requests:
+                    if 'DeleteRequest' in request:
+                        self.tables[table].pop(self._key(table, request['DeleteRequest']['Key']), None)
+                    else:
+                        item = request['PutRequest']['Item']
+                        self.tables[table][self._key(table, item)] = dict(item)
+        return {'UnprocessedItems': {}}
+
+    def get_paginator(self, operation_name):
+        return _FakePaginator(self, operation_name)
+
+
+class _FakePaginator:
+    _PAGE_SIZE = 1000
+
+    def __init__(self, dynamo: FakeDynamoDB, operation_name: str):
+        self.dynamo = dynamo
+        self.operation_name = operation_name
+
+    def paginate(self, TableName, **kwargs):
+        items = list(self.dynamo.tables[TableName].values())
+        if self.operation_name == 'query':
+            # Conditions are equalities written against ':<attribute>' placeholders, as revoke.py does
+            conditions = [(name[1:], value) for name, value in kwargs['ExpressionAttributeValues'].items()]
+            items = [item for item in items if all(item.get(name) == value for name, value in conditions)]
+        for start in range(0, max(len(items), 1), self._PAGE_SIZE):
+            self.dynamo.backends.call('dynamodb', self.operation_name)
+            yield {'Items': [dict(item) for item in items[start:start + self._PAGE_SIZE]]}
+
+
+class FakeSTS:
+
+    def __init__(self, backends: Backends, duration_limit: int = 3600):
+        self.backends = backends
+        self.duration_limit = duration_limit
+
+    def assume_role(self, RoleArn, DurationSeconds, RoleSessionName, **kwargs):
+        self.backends.call('sts', 'assume_role')
+        if int(DurationSeconds) > self.duration_limit:
+            raise _client_error('ValidationError', 'AssumeRole')
+        return {'Credentials': {
+            'AccessKeyId': 'ASIA' + uuid.uuid4().hex[:16].upper(),
+            'SecretAccessKey': uuid.uuid4().hex,
+            'SessionToken': uuid.uuid4().hex * 4,
+            'Expiration': datetime.datetime.now(datetime.timezone.utc) +
+                          datetime.timedelta(seconds=int(DurationSeconds))
+        }}
+
+
+class FakeSSM:
+
+    def __init__(self, backends: Backends):
+        self.backends = backends
+
+    def get_parameter(self, Name, **kwargs):
+        self.backends.call('ssm', 'get_parameter')
+        return {'Parameter': {'Name': Name, 'Value': _KUBECONFIG}}
+
+
+class FakeCoreV1Api:
+    """Implements the CoreV1Api calls made by the webhook against in-memory ServiceAccounts, Secrets & Pods."""
+
+    def __init__(self, backends: Backends):
+        self.backends = backends
+        self.service_accounts = {}
+        self.secrets = {}
+        self.pods = {}
+        self._lock = threading.Lock()
+
+    def add_service_account(self, namespace: str, name: str, annotations: dict = None) -> None:
+        self.service_accounts[(namespace, name)] = client.V1ServiceAccount(
+            metadata=client.V1ObjectMeta(name=name, namespace=namespace, annotations=annotations,
+                                         resource_version='1'))
+
+    def read_namespaced_service_account(self, name, namespace, **kwargs):
+        self.backends.call('kubernetes', 'read_namespaced_service_account')
+        if (namespace, name) not in self.service_accounts:
+            raise ApiException(status=404)
+        return self.service_accounts[(namespace, name)]
+
+    def create_namespaced_secret(self, namespace, body, **kwargs):
+        self.backends.call('kubernetes', 'create_namespaced_secret')
+        key = (namespace, body['metadata']['name'])
+        with self._lock:
+            if key in self.secrets:
+                raise ApiException(status=409)
+            self.secrets[key] = body
+        return body
+
+    def read_namespaced_secret(self, name, namespace, **kwargs):
+        self.backends.call('kubernetes', 'read_namespaced_secret')
+        if (namespace, name) not in self.secrets:
+            raise ApiException(status=404)
+        body = self.secrets[(namespace, name)]
+        return client.V1Secret(
+            metadata=client.V1ObjectMeta(name=name, namespace=namespace,
+                                         labels=body['metadata'].get('labels')),
+            data={key: base64.b64encode(value.encode('utf-8')).decode('utf-8')
+                  for key, value in body['stringData'].items()})
+
+    def delete_namespaced_secret(self, name, namespace, **kwargs):
+        self.backends.call('kubernetes', 'delete_namespaced_secret')
+        with self._lock:
+            if self.secrets.pop((namespace, name), None) is None:
+                raise ApiException(status=404)
+        return None
+
+
+@contextlib.contextmanager
+def installed(backends: Backends):
+    """Routes the shared AWS clients and every CoreV1Api constructed by the webhook to fresh fakes."""
+    import clients
+    import webhook
+
+    fakes = {
+        'dynamodb': FakeDynamoDB(backends),
+        'sts': FakeSTS(backends),
+        'ssm': FakeSSM(backends),
+        'kubernetes': FakeCoreV1Api(backends)
+    }
+    saved_clients = dict(clients._clients)
+    saved_core_api = client.CoreV1Api
+    clients._clients.clear()
+    clients._clients.update({clients.client_key(name, sdk_retries): fakes[name]
+                             for name in ('dynamodb', 'sts', 'ssm') for sdk_retries in (True, False)})
+    client.CoreV1Api = lambda *args, **kwargs: fakes['kubernetes']
+    webhook.kube_init = False
+    try:
+        yield fakes
+    finally:
+        client.CoreV1Api = saved_core_api
+        clients._clients.clear()
+        clients._clients.update(saved_clients)
@@ -0,0 +1,264 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Offline benchmarks of the broker GET, webhook admission and stream paths of index.handler against the fakes in
+  benchmarks/fakes.py. Reports latency percentiles, backend calls per request and allocations.
+
+      $ python benchmarks/run.py --requests 200 --latency dynamodb=5 --latency sts=20 --latency kubernetes=5
+      $ python benchmarks/run.py --scenario pod-storm --max-p99 50
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakes  # noqa: E402
+
+_ROLE = 'arn:aws:iam::111111111111:role/bench'
+
+
+def _reset_caches() -> None:
+    import allowances
+    import broker
+    import webhook
+
+    broker._credential_cache.clear()
+    broker._unknown_tokens.clear()
+    webhook._sa_annotation_cache.clear()
+    webhook._shared_secrets.clear()
+    allowances.invalidate()
+
+
+def _seed(environment: dict, namespace: str = 'bench', service_account: str = 'app-sa') -> None:
+    environment['kubernetes'].add_service_account(namespace, service_account,
+                                                  {'eks.amazonaws.com/role-arn': _ROLE})
+    environment['dynamodb'].put_item(TableName=os.getenv('MAP_TABLE', 'mapped_roles'), Item={
+        'namespace': {'S': namespace},
+        'service_account': {'S': service_account},
+        'allowed_roles': {'SS': [_ROLE]}
+    })
+
+
+def _authorization(environment: dict, namespace: str = 'bench', service_account: str = 'app-sa') -> str:
+    token = uuid.uuid4().hex
+    environment['dynamodb'].put_item(TableName=os.getenv('AUTH_TABLE', 'role_perms'), Item={
+        'auth_token': {'S': token},
+        'namespace': {'S': namespace},
+        'secret_name': {'S': 'broker-authorization-' + token[:32]},
+        'role_arn': {'S': _ROLE},
+        'service_account': {'S': service_account},
+        'expires': {'N': str(int(time.time()) + 86400)}
+    })
+    return token
+
+
+def _admission_event(namespace: str = 'bench', service_account: str = 'app-sa', containers: int = 2) -> dict:
+    return {'httpMethod': 'POST', 'body': json.dumps({
+        'apiVersion': 'admission.k8s.io/v1',
+        'kind': 'AdmissionReview',
+        'request': {
+            'uid': str(uuid.uuid4()),
+            'kind': {'group': '', 'version': 'v1', 'kind': 'Pod'},
+            'namespace': namespace,
+            'operation': 'CREATE',
+            'object': {
+                'kind': 'Pod',
+                'apiVersion': 'v1',
+                'metadata': {'generateName': 'bench-', 'namespace': namespace},
+                'spec': {
+                    'serviceAccountName': service_account,
+                    'containers': [{'name': 'app-%d' % index, 'image': 'quay.io/cuppett/aws-cli'}
+                                   for index in range(containers)]
+                }
+            }
+        }
+    })}
+
+
+def _check(response: dict, status: int) -> None:
+    if response is None or response.get('statusCode') != status:
+        raise AssertionError('Unexpected response: %s' % response)
+
+
+def broker_get(environment: dict, requests: int) -> []:
+    """Warm credential GETs for a handful of pods."""
+    tokens = [_authorization(environment) for _ in range(10)]
+    return [lambda token=tokens[index % len(tokens)]: _check(
+        index_handler({'httpMethod': 'GET', 'headers': {'Authorization': token}}), 200) for index in range(requests)]
+
+
+def credential_refresh_storm(environment: dict, requests: int) -> []:
+    """Every pod's cached credential expires at once and all of their SDKs ask again."""
+    tokens = [_authorization(environment) for _ in range(max(1, requests // 4))]
+    return [lambda token=tokens[index % len(tokens)]: _check(
+        index_handler({'httpMethod': 'GET', 'headers': {'Authorization': token}}), 200) for index in range(requests)]
+
+
+def pod_storm(environment: dict, requests: int) -> []:
+    """A Deployment scaling up: N pod admissions for the same ServiceAccount."""
+    _seed(environment)
+
+    def admit():
+        response = index_handler(_admission_event())
+        _check(response, 200)
+        if json.loads(response['body'])['response']['patch'] == 'W10=':
+            raise AssertionError('Pod was not mutated')
+    return [admit for _ in range(requests)]
+
+
+def skipped_admissions(environment: dict, requests: int) -> []:
+    """Cluster churn which can never be mutated: system namespaces, already injected pods and dry runs."""
+    _seed(environment)
+
+    def event(index):
+        admission = _admission_event(namespace=('openshift-monitoring', 'bench', 'bench')[index % 3])
+        body = json.loads(admission['body'])
+        if index % 3 == 1:
+            body['request']['object']['spec']['containers'].append({'name': 'ocp-broker-proxy', 'image': 'proxy'})
+        elif index % 3 == 2:
+            body['request']['dryRun'] = True
+        admission['body'] = json.dumps(body)
+        return admission
+
+    def admit(admission):
+        response = index_handler(admission)
+        _check(response, 200)
+        if json.loads(response['body'])['response']['patch'] != 'W10=':
+            raise AssertionError('Pod was mutated')
+    return [lambda admission=event(index): admit(admission) for index in range(requests)]
+
+
+def stream_remove(environment: dict, requests: int, batch: int = 100) -> []:
+    """Authorizations expired by the TTL sweeper, delivered as REMOVE batches."""
+    def remove_batch():
+        records = []
+        for _ in range(batch):
+            name = 'broker-authorization-' + uuid.uuid4().hex
+            environment['kubernetes'].secrets[('bench', name)] = {'metadata': {'name': name}, 'stringData': {}}
+            records.append({'eventName': 'REMOVE', 'eventSourceARN': 'arn:aws:dynamodb:::table/role_perms/stream/1',
+                            'dynamodb': {'SequenceNumber': uuid.uuid4().hex, 'OldImage': {
+                                'namespace': {'S': 'bench'}, 'secret_name': {'S': name}}}})
+        result = index_handler({'Records': records})
+        if result['batchItemFailures']:
+            raise AssertionError('Failed removals: %s' % result)
+    return [remove_batch for _ in range(max(1, requests // batch))]
+
+
+def index_handler(event: dict) -> dict:
+    import index
+    return index.handler(event, None)
+
+
+SCENARIOS = {
+    'broker-get': (broker_get, 1),
+    'credential-refresh-storm': (credential_refresh_storm, 16),
+    'pod-storm': (pod_storm, 16),
+    'skipped-admissions': (skipped_admissions, 1),
+    'stream-remove': (stream_remove, 1)
+}
+
+
+def _percentile(samples: [], percentile: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(percentile / 100.0 * (len(ordered) - 1))))]
+
+
+def _run(calls: [], concurrency: int) -> []:
+    def timed(call):
+        started = time.perf_counter()
+        call()
+        return (time.perf_counter() - started) * 1000
+
+    if concurrency <= 1:
+        return [timed(call) for call in calls]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(timed, calls))
+
+
+def run_scenario(name: str, requests: int, latency: dict) -> dict:
+    factory, concurrency = SCENARIOS[name]
+
+    # Timed pass
+    backends = fakes.Backends(latency)
+    with fakes.installed(backends) as environment:
+        _reset_caches()
+        calls = factory(environment, requests)
+        backends.reset()
+        samples = _run(calls, concurrency)
+        counts = dict(backends.calls)
+
+    # Allocation pass, without injected latency
+    backends = fakes.Backends()
+    with fakes.installed(backends) as environment:
+        _reset_caches()
+        calls = factory(environment, requests)
+        tracemalloc.start()
+        _run(calls, 1)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        'scenario': name,
+        'requests': len(samples),
+        'p50_ms': round(_percentile(samples, 50), 3),
+        'p95_ms': round(_percentile(samples, 95), 3),
+        'p99_ms': round(_percentile(samples, 99), 3),
+        'calls_per_request': {call: round(count / len(samples), 3) for call, count in sorted(counts.items())},
+        'retained_kib': round(current / 1024, 1),
+        'peak_kib': round(peak / 1024, 1)
+    }
+
+
+def _latency(values: []) -> dict:
+    latency = {}
+    for value in values or []:
+        backend, milliseconds = value.split('=')
+        latency[backend] = float(milliseconds) / 1000
+    return latency
+
+
+def main(argv: [] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='Scenario to run (repeatable, defaults to all)')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per scenario')
+    parser.add_argument('--latency', action='append', metavar='BACKEND=MS',
+                        help='Injected latency per call for dynamodb, sts, ssm or kubernetes (repeatable)')
+    parser.add_argument('--max-p99', type=float, metavar='MS', help='Exit non-zero when any p99 exceeds this')
+    parser.add_argument('--json', action='store_true', help='Print one JSON document per scenario')
+    args = parser.parse_args(argv)
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    os.environ.setdefault('APP_METRICS', 'false')
+    exceeded = False
+    for name in args.scenario or sorted(SCENARIOS):
+        result = run_scenario(name, args.requests, _latency(args.latency))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('%-26s n=%-5d p50=%8.3fms p95=%8.3fms p99=%8.3fms peak=%8.1fKiB' % (
+                name, result['requests'], result['p50_ms'], result['p95_ms'], result['p99_ms'], result['peak_kib']))
+            for call, count in result['calls_per_request'].items():
+                print('    %-50s %8.3f/request' % (call, count))
+        if args.max_p99 is not None and result['p99_ms'] > args.max_p99:
+            exceeded = True
+
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
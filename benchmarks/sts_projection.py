@@ -0,0 +1,69 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Projects the broker invocations and AssumeRole calls per hour for a fleet of pods at different session durations.
+  A sidecar asks the broker again once its credential is within 5 minutes of expiration (the Cache-control max-age),
+  so every pod costs one call per (duration - 300) seconds. Durations are capped by MAX_DURATION (one hour unless the
+  broker runs with long-term credentials, see the guide) and raised to the 900 second STS minimum as the broker does.
+
+      $ python benchmarks/sts_projection.py --pods 2000 --duration 900 --duration 3600
+"""
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import broker  # noqa: E402
+
+
+def calls_per_hour(duration: int) -> float:
+    return 3600.0 / (duration - broker._EXPIRY_MARGIN)
+
+
+def project(pods: int, durations: [], max_duration: int) -> []:
+    effective = [max(900, min(duration, max_duration)) for duration in durations]
+    baseline = calls_per_hour(effective[0])
+    return [{
+        'duration': duration,
+        'effective_duration': capped,
+        'calls_per_pod_hour': round(calls_per_hour(capped), 3),
+        'calls_per_hour': round(pods * calls_per_hour(capped), 1),
+        'reduction_pct': round(100 * (1 - calls_per_hour(capped) / baseline), 1)
+    } for duration, capped in zip(durations, effective)]
+
+
+def main(argv: [] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pods', type=int, default=1000, help='Pods holding credentials')
+    parser.add_argument('--duration', type=int, action='append', metavar='SECONDS',
+                        help='Session duration to project (repeatable, the first is the baseline)')
+    parser.add_argument('--max-duration', type=int, default=int(os.getenv('MAX_DURATION', 3600)), metavar='SECONDS',
+                        help='MAX_DURATION of the broker (default: %(default)s)')
+    parser.add_argument('--json', action='store_true', help='Print one JSON document per duration')
+    args = parser.parse_args(argv)
+
+    durations = args.duration or [900, 1800, 3600]
+    for result in project(args.pods, durations, args.max_duration):
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print('duration=%-6d %8.3f calls/pod/hour %10.1f calls/hour %6.1f%% fewer than %ds%s' % (
+                result['duration'], result['calls_per_pod_hour'], result['calls_per_hour'], result['reduction_pct'],
+                durations[0], '' if result['effective_duration'] == result['duration'] else
+                (' (capped to %ds by MAX_DURATION)' if result['effective_duration'] < result['duration'] else
+                 ' (raised to %ds, the STS minimum)') % result['effective_duration']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
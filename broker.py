@@ -9,85 +9,259 @@
   permissions and limitations under the License.
 """
 
-import boto3
+import cache
+import clients
+import concurrent.futures
 import datetime
 import json
 import logging
 import math
+import metrics
 import os
+import ratelimit
+import resilience
 
 from botocore.exceptions import ClientError
 
+# Credentials are handed out (and cached) until 300 seconds (5 minutes) short of their expiration.
+_EXPIRY_MARGIN = 300
+
 _logger = logging.getLogger()
 _logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
 
-if os.getenv('AWS_REGION'):
-    boto3.setup_default_session(region_name=os.getenv('AWS_REGION'))
+# Keyed by (auth_token, role_arn), kept across warm invocations of the container.
+_credential_cache = cache.LRUCache(int(os.getenv('CREDENTIAL_CACHE_SIZE', 1024)))
 
+# Tokens without an authorization, answered with a 404 until NEGATIVE_CACHE_TTL passes without a lookup.
+_unknown_tokens = cache.LRUCache(int(os.getenv('NEGATIVE_CACHE_SIZE', 4096)),
+                                 ttl=float(os.getenv('NEGATIVE_CACHE_TTL', 30)))
 
-def _get_arn(lookup_token):
+# Requests allowed per authorization token and per source IP (token buckets, 0 disables). Both are off by default: a
+# shared token (SHARE_AUTHORIZATIONS) is refreshed by every replica at once, and pods behind a NAT share an address.
+_token_limiter = ratelimit.TokenBucketLimiter(float(os.getenv('TOKEN_RATE_LIMIT', 0)),
+                                              float(os.getenv('TOKEN_RATE_BURST', 20)))
+_source_limiter = ratelimit.TokenBucketLimiter(float(os.getenv('SOURCE_RATE_LIMIT', 0)),
+                                               float(os.getenv('SOURCE_RATE_BURST', 200)))
+
+# Counters for the last_accessed/expires refreshes made (or avoided) against the Authorizations table.
+_refresh_stats = {'written': 0, 'suppressed': 0, 'deferred': 0, 'failed': 0}
+
+# Single background writer used when LAST_ACCESSED_WRITE_MODE is 'deferred'. Tokens already queued are not queued again.
+_refresh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+_pending_refreshes = set()
+
+# Roles which refused a longer session duration, with the duration to use instead.
+_role_duration_caps = {}
+
+# Stop calling (and answer 503 with Retry-After) while STS or DynamoDB keeps throttling or failing.
+_breakers = {'dynamodb': resilience.CircuitBreaker('dynamodb'), 'sts': resilience.CircuitBreaker('sts')}
+
+
+def _write_last_accessed(lookup_token: str) -> None:
+    """Resetting/refreshing the last_accessed/expires TTLs"""
+    try:
+        now = datetime.datetime.now()
+        expires_days_in_seconds = int(os.getenv('EXPIRES_IN_DAYS', 14)) * 86400
+        expires_ts = now + datetime.timedelta(seconds=expires_days_in_seconds)
+        expires_ttl = math.floor(expires_ts.timestamp())
+        last_accessed = math.floor(now.timestamp())
+
+        with metrics.span('update_item'):
+            resilience.call(
+                _breakers['dynamodb'], clients.get_client('dynamodb', sdk_retries=False).update_item,
+                TableName=os.getenv('AUTH_TABLE', 'role_perms'),
+                Key={
+                    'auth_token': { 'S': lookup_token }
+                },
+                UpdateExpression="set expires = :e, last_accessed=:l",
+                ExpressionAttributeValues={
+                    ':e': { 'N': str(expires_ttl) },
+                    ':l': { 'N': str(last_accessed) }
+                },
+                ReturnValues='NONE'
+            )
+        _refresh_stats['written'] += 1
+    except Exception as e:
+        _refresh_stats['failed'] += 1
+        _logger.error("Unexpected error: %s" % e)
+    finally:
+        _pending_refreshes.discard(lookup_token)
+
+
+def _refresh_last_accessed(lookup_token: str, item: dict) -> None:
+    """Bumps last_accessed/expires on the row unless it was already refreshed within LAST_ACCESSED_REFRESH_SECONDS.
+    In 'deferred' mode the write is queued to the background writer instead of delaying the response."""
+    if 'last_accessed' in item:
+        age = datetime.datetime.now().timestamp() - int(item['last_accessed']['N'])
+        if age < int(os.getenv('LAST_ACCESSED_REFRESH_SECONDS', 3600)):
+            _refresh_stats['suppressed'] += 1
+            metrics.count('last_accessed_suppressed')
+            return
+
+    if os.getenv('LAST_ACCESSED_WRITE_MODE', 'sync') == 'deferred':
+        if lookup_token in _pending_refreshes:
+            _refresh_stats['suppressed'] += 1
+        else:
+            _pending_refreshes.add(lookup_token)
+            _refresh_stats['deferred'] += 1
+            _refresh_executor.submit(_write_last_accessed, lookup_token)
+    else:
+        _write_last_accessed(lookup_token)
+
+
+def flush_refreshes(timeout: float = None) -> None:
+    """Waits for the deferred last_accessed writes queued so far to complete."""
+    _refresh_executor.submit(lambda: None).result(timeout)
+
+
+@metrics.timed('get_arn')
+def _get_authorization(lookup_token) -> dict:
+    """Returns the Authorizations item for the token, or None when there is not one."""
     if lookup_token is not None:
-        client = boto3.client('dynamodb')
-        row = client.get_item(TableName=os.getenv('AUTH_TABLE', 'role_perms'),
+        if _unknown_tokens.get(lookup_token) is not None:
+            metrics.count('negative_cache_hit')
+            return None
+        client = clients.get_client('dynamodb', sdk_retries=False)
+        row = resilience.call(_breakers['dynamodb'], client.get_item, TableName=os.getenv('AUTH_TABLE', 'role_perms'),
                               Key={'auth_token': {'S': lookup_token}})
-        if row is not None:
-            # Resetting/refreshing the last_accessed/expires TTLs
-            try:
-                now = datetime.datetime.now()
-                expires_days_in_seconds = os.getenv('EXPIRES_IN_DAYS', 14) * 86400
-                expires_ts = now + datetime.timedelta(seconds=expires_days_in_seconds)
-                expires_ttl = math.floor(expires_ts.timestamp())
-                last_accessed = math.floor(now.timestamp())
-
-                client.update_item(
-                    TableName=os.getenv('AUTH_TABLE', 'role_perms'),
-                    Key={
-                        'auth_token': { 'S': lookup_token }
-                    },
-                    UpdateExpression="set expires = :e, last_accessed=:l",
-                    ExpressionAttributeValues={
-                        ':e': { 'N': str(expires_ttl) },
-                        ':l': { 'N': str(last_accessed) }
-                    },
-                    ReturnValues='NONE'
-                )
-            except Exception as e:
-                _logger.error("Unexpected error: %s" % e)
-
-            return row['Item']['role_arn']['S']
+        if row is not None and 'Item' in row:
+            _refresh_last_accessed(lookup_token, row['Item'])
+            return row['Item']
 
         else:
+            _unknown_tokens.put(lookup_token, True)
             return None
     else:
         return None
 
 
+def _get_arn(lookup_token):
+    authorization = _get_authorization(lookup_token)
+    return None if authorization is None else authorization['role_arn']['S']
+
+
+def _session_duration(authorization: dict) -> int:
+    """The STS session duration for the authorization: its own (copied from the Allowances table by the webhook) or
+    DEFAULT_DURATION, capped by MAX_DURATION and by what the role has been found to accept. Durations under 900
+    seconds (the least STS accepts) are raised to it."""
+    duration = int(os.getenv('DEFAULT_DURATION', 900))
+    if 'duration' in authorization:
+        duration = int(authorization['duration']['N'])
+    if duration < 900:
+        _logger.warning('Raising the %d second session of %s to the 900 second minimum', duration,
+                        authorization['role_arn']['S'])
+        duration = 900
+    duration = min(duration, int(os.getenv('MAX_DURATION', 3600)))
+    return min(duration, _role_duration_caps.get(authorization['role_arn']['S'], duration))
+
+
+def _shorter_durations(duration: int) -> []:
+    """Durations to try once a role refused duration: halving it down to one hour (the lowest maximum session
+    duration a role can have), then DEFAULT_DURATION."""
+    default_duration = int(os.getenv('DEFAULT_DURATION', 900))
+    durations = []
+    while duration > 3600:
+        duration = max(3600, duration // 2)
+        durations.append(duration)
+    if default_duration < duration:
+        durations.append(default_duration)
+    return durations
+
+
+def _assume_role(arn: str, duration: int, auth_token: str) -> dict:
+    sts_client = clients.get_client('sts', sdk_retries=False)
+    try:
+        with metrics.span('assume_role'):
+            return resilience.call(_breakers['sts'], sts_client.assume_role, RoleArn=arn, DurationSeconds=duration,
+                                   RoleSessionName=auth_token)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ValidationError':
+            raise
+        refused = e
+
+    # Longer than the role's maximum session duration, remembering the first shorter one it accepts
+    for shorter in _shorter_durations(duration):
+        try:
+            with metrics.span('assume_role'):
+                credentials = resilience.call(_breakers['sts'], sts_client.assume_role, RoleArn=arn,
+                                              DurationSeconds=shorter, RoleSessionName=auth_token)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationError':
+                raise
+            continue
+        _logger.warning('Role %s refused a %d second session, falling back to %d seconds', arn, duration, shorter)
+        _role_duration_caps[arn] = shorter
+        return credentials
+    raise refused
+
+
+def _seconds_until_refresh(expiration: datetime.datetime) -> int:
+    return int(expiration.timestamp() - datetime.datetime.now(datetime.timezone.utc).timestamp()) - _EXPIRY_MARGIN
+
+
 def _get_credentials(auth_token):
-    arn = None
+    authorization = None
     if auth_token is not None:
-        arn = _get_arn(auth_token)
+        authorization = _get_authorization(auth_token)
+
+    if authorization is not None:
+        arn = authorization['role_arn']['S']
+        cached = _credential_cache.get((auth_token, arn))
+        if cached is not None:
+            ecs_payload, expiration = cached
+            delta_in_seconds = _seconds_until_refresh(expiration)
+            if delta_in_seconds > 0:
+                metrics.count('credential_cache_hit')
+                return ecs_payload, delta_in_seconds
 
-    if arn is not None:
-        sts_client = boto3.client('sts')
-        credentials = sts_client.assume_role(RoleArn=arn,
-                                             DurationSeconds=os.getenv('DEFAULT_DURATION', 900),
-                                             RoleSessionName=auth_token)
+        credentials = _assume_role(arn, _session_duration(authorization), auth_token)
 
         # Calculating 300 seconds (5 minutes) short of the expiration for allowing caching.
-        delta_in_seconds = int(credentials['Credentials']['Expiration'].strftime("%s")) - \
-                int(datetime.datetime.utcnow().strftime("%s")) - 300
+        expiration = credentials['Credentials']['Expiration']
+        delta_in_seconds = _seconds_until_refresh(expiration)
 
         ecs_payload = {
             'AccessKeyId': credentials['Credentials']['AccessKeyId'],
             'SecretAccessKey': credentials['Credentials']['SecretAccessKey'],
             'Token': credentials['Credentials']['SessionToken'],
-            'Expiration': credentials['Credentials']['Expiration'].isoformat()
+            'Expiration': expiration.isoformat()
         }
+        if delta_in_seconds > 0:
+            _credential_cache.put((auth_token, arn), (ecs_payload, expiration), ttl=delta_in_seconds)
+            _logger.debug('Credential cache: %s', _credential_cache.stats())
         return ecs_payload, delta_in_seconds
     else:
         return None, None
 
 
+def _cache_control(max_age: int) -> str:
+    """Lets caching proxies keep serving the credential while they refresh it in the background (or while the broker
+    is failing). Both windows stay inside the 5 minutes the credential is still valid for after max-age."""
+    stale_while_revalidate = min(int(os.getenv('STALE_WHILE_REVALIDATE', 60)), _EXPIRY_MARGIN)
+    stale_if_error = min(int(os.getenv('STALE_IF_ERROR', 240)), _EXPIRY_MARGIN)
+    return 'max-age=%d, stale-while-revalidate=%d, stale-if-error=%d' % (max_age, stale_while_revalidate,
+                                                                         stale_if_error)
+
+
+def _source_ip(event) -> str:
+    return ((event.get('requestContext') or {}).get('identity') or {}).get('sourceIp')
+
+
+def _rate_limited(event, auth_token: str) -> float:
+    """Takes a token from the source's and the authorization token's buckets, returning the seconds to wait (0 when the
+    request is allowed)."""
+    source_ip = _source_ip(event)
+    if source_ip is not None:
+        wait = _source_limiter.acquire(source_ip)
+        if wait > 0:
+            metrics.count('rate_limited_source')
+            return wait
+    wait = _token_limiter.acquire(auth_token)
+    if wait > 0:
+        metrics.count('rate_limited_token')
+    return wait
+
+
 def handler(event, context):
 
     to_return = {
@@ -98,9 +272,23 @@ def handler(event, context):
         if event and 'Authorization' in event['headers']:
             auth_token = event['headers']['Authorization']
 
+            wait = _rate_limited(event, auth_token)
+            if wait > 0:
+                # Cacheable, so the sidecar answers the retries until the bucket has refilled
+                retry_after = max(1, math.ceil(wait))
+                to_return['statusCode'] = 429
+                to_return['headers']['Retry-After'] = str(retry_after)
+                to_return['headers']['Cache-control'] = 'max-age=%d' % retry_after
+                to_return['body'] = json.dumps({'output': 'Too Many Requests'})
+                return to_return
+
             credentials, max_age = _get_credentials(auth_token)
+            _logger.debug('last_accessed refreshes: %s', _refresh_stats)
             if max_age is not None and max_age > 0:
-                to_return['headers']['Cache-control'] = ('max-age=' + str(max_age))
+                to_return['headers']['Cache-control'] = _cache_control(max_age)
+            elif credentials is None:
+                # Unknown tokens are cached here as well, so the sidecar stops asking for a while
+                to_return['headers']['Cache-control'] = 'max-age=%d' % _unknown_tokens.ttl
             else:
                 to_return['headers']['Cache-control'] = 'no-cache'
 
@@ -118,6 +306,16 @@ def handler(event, context):
             }
             to_return['statusCode'] = 401
 
+    except resilience.CircuitOpen as e:
+        _logger.debug(e)
+        data = {
+            'output': 'Service Unavailable',
+            'timestamp': datetime.datetime.utcnow().isoformat()
+        }
+        to_return['statusCode'] = 503
+        to_return['headers']['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+        to_return['headers']['Cache-control'] = 'no-cache'
+
     except ClientError as e:
         if e.response['Error']['Code'] == 'ResourceNotFoundException':
             _logger.error("Table does not exist: %s" % e)
@@ -128,6 +326,9 @@ def handler(event, context):
             'timestamp': datetime.datetime.utcnow().isoformat()
         }
         to_return['statusCode'] = 503
+        if resilience.is_throttling(e):
+            breaker = _breakers['sts' if e.operation_name == 'AssumeRole' else 'dynamodb']
+            to_return['headers']['Retry-After'] = str(breaker.retry_after())
 
     to_return['body'] = json.dumps(data)
     return to_return
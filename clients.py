@@ -0,0 +1,60 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+"""
+
+import boto3
+import os
+import threading
+
+from botocore.config import Config
+
+if os.getenv('AWS_REGION'):
+    boto3.setup_default_session(region_name=os.getenv('AWS_REGION'))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _client_config(sdk_retries: bool = True) -> Config:
+    return Config(
+        max_pool_connections=int(os.getenv('CLIENT_MAX_POOL_CONNECTIONS', 10)),
+        tcp_keepalive=os.getenv('CLIENT_TCP_KEEPALIVE', 'true') == 'true',
+        retries={
+            'mode': os.getenv('CLIENT_RETRY_MODE', 'adaptive'),
+            'max_attempts': int(os.getenv('CLIENT_MAX_ATTEMPTS', 3)) if sdk_retries else 1
+        }
+    )
+
+
+def client_key(service_name: str, sdk_retries: bool = True) -> str:
+    return service_name if sdk_retries else service_name + ':single-attempt'
+
+
+def get_client(service_name: str, sdk_retries: bool = True):
+    """Returns the shared boto3 client for the service, building it on first use.
+
+    Clients (and their connection pools) are reused for the life of the container; boto3 clients are thread-safe.
+    Callers retrying through resilience.call ask for sdk_retries=False, a client making a single attempt per call, so
+    the retries are not multiplied and every throttled attempt reaches the circuit breaker."""
+    key = client_key(service_name, sdk_retries)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service_name, config=_client_config(sdk_retries))
+                _clients[key] = client
+    return client
+
+
+def reset() -> None:
+    """Drops every cached client, forcing them to be rebuilt on next use."""
+    with _lock:
+        _clients.clear()
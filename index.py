@@ -9,25 +9,106 @@
   permissions and limitations under the License.
 """
 
+# The broker and webhook modules are imported within the branches that need them. This keeps the
+# credential (GET) path from loading kubernetes, jsonpatch & yaml during a cold start.
 import os
 import logging
-import broker
-import webhook
+import metrics
+import time
 
 _logger = logging.getLogger()
 _logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
 
 
-def handler(event, context):
+def _elapsed_ms(started: float) -> float:
+    return round((time.perf_counter() - started) * 1000, 3)
 
-    _logger.debug(event)
+
+def warmup() -> dict:
+    """Loads the modules, AWS clients and Kubernetes configuration without serving any request."""
+    timings = {}
+
+    started = time.perf_counter()
+    import broker
+    timings['broker_import_ms'] = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    import webhook
+    timings['webhook_import_ms'] = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    import clients
+    for service_name in ('dynamodb', 'sts', 'ssm'):
+        clients.get_client(service_name)
+    # The broker's single-attempt clients, retried by resilience.call
+    for service_name in ('dynamodb', 'sts'):
+        clients.get_client(service_name, sdk_retries=False)
+    timings['clients_ms'] = _elapsed_ms(started)
+
+    started = time.perf_counter()
+    try:
+        webhook._get_kube_config()
+    except Exception as e:
+        _logger.error('Unable to load kubeconfig during warm-up: %s', e)
+    timings['kube_config_ms'] = _elapsed_ms(started)
+
+    _logger.info('Warm-up completed: %s', timings)
+    return {'warmup': timings}
+
+
+def _process_records(records: []) -> dict:
+    """Applies a DynamoDB stream batch, reporting only the records which failed so just those are retried."""
+    import allowances
+    import webhook
+
+    failures = []
+    removals = {}
+    for record in records:
+        if allowances.is_allowances_record(record):
+            allowances.apply_stream_record(record)
+        elif record['eventName'] == 'REMOVE':
+            try:
+                secret = (record['dynamodb']['OldImage']['namespace']['S'],
+                          record['dynamodb']['OldImage']['secret_name']['S'])
+                removals.setdefault(secret, []).append(record['dynamodb']['SequenceNumber'])
+            except KeyError as e:
+                _logger.error('Skipping malformed REMOVE record, missing %s', e)
+
+    try:
+        failed = webhook.remove_secrets(list(removals))
+    except Exception as e:
+        _logger.error('Unable to remove secrets: %s', e)
+        failed = list(removals)
+
+    for secret in failed:
+        failures.extend(removals[secret])
+    if len(failed) > 0:
+        _logger.error('Failed to remove %d of %d secrets', len(failed), len(removals))
+    return {'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failures]}
+
+
+def _path(event) -> str:
+    if 'httpMethod' in event:
+        return {'GET': 'broker', 'POST': 'webhook'}.get(event['httpMethod'], 'invalid')
+    elif 'Records' in event:
+        return 'stream'
+    elif 'reconcile' in event:
+        return 'reconcile'
+    elif 'revoke' in event:
+        return 'revoke'
+    return 'warmup' if 'warmup' in event else 'unknown'
+
+
+def _dispatch(event, context):
     to_return = None
 
     # Processing the API Gateway forwarded requests.
     if 'httpMethod' in event:
         if event['httpMethod'] == 'GET':
+            import broker
             to_return = broker.handler(event, context)
         elif event['httpMethod'] == 'POST':
+            import webhook
             to_return = webhook.handler(event, context)
 
         if to_return is None:
@@ -37,17 +118,33 @@ def handler(event, context):
                 'body': {'data': {'output': 'Invalid invocation'}}
             }
 
-    # Processing DynamoDB record removals
+    # Processing DynamoDB stream records: Allowances changes and Authorizations removals
     elif 'Records' in event:
-        for record in event['Records']:
-            if record['eventName'] == 'REMOVE':
-                webhook.remove_secret(
-                    record['dynamodb']['OldImage']['namespace']['S'],
-                    record['dynamodb']['OldImage']['secret_name']['S']
-                )
+        to_return = _process_records(event['Records'])
+
+    # Scheduled or provisioned warm-up ping, e.g. {"warmup": true}
+    elif 'warmup' in event:
+        to_return = warmup()
+
+    # Scheduled cleanup of orphaned Secrets & Authorizations, e.g. {"reconcile": {"dry_run": true}}
+    elif 'reconcile' in event:
+        import reconcile
+        to_return = reconcile.handler(event['reconcile'])
+
+    # Bulk revocation by namespace, service account or role, e.g. {"revoke": {"namespace": "app1"}}
+    elif 'revoke' in event:
+        import revoke
+        to_return = revoke.handler(event['revoke'])
 
     return to_return
 
 
+def handler(event, context):
+
+    _logger.debug(event)
+    with metrics.invocation(_path(event)):
+        return _dispatch(event, context)
+
+
 if __name__ == "__main__":
     print(handler({'httpMethod': 'GET', 'headers': {'Authorization': os.getenv('AUTH_TOKEN')}}, None))
@@ -0,0 +1,127 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import functools
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+_logger = logging.getLogger()
+_logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
+
+_current = contextvars.ContextVar('metrics_invocation', default=None)
+
+
+class Invocation:
+    """Per-phase timings (milliseconds) and counters collected while serving one event."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.timings = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def add_timing(self, name: str, milliseconds: float) -> None:
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + milliseconds
+
+    def add_count(self, name: str, value: int) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def span(name: str):
+    """Times the enclosed block into the current invocation (a no-op outside of one)."""
+    invocation = _current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if invocation is not None:
+            invocation.add_timing(name, (time.perf_counter() - started) * 1000)
+
+
+def timed(name: str):
+    """Decorator form of span()."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: int = 1) -> None:
+    invocation = _current.get()
+    if invocation is not None:
+        invocation.add_count(name, value)
+
+
+def _emf(invocation: Invocation, total_ms: float) -> dict:
+    """Formats the invocation as a CloudWatch embedded metric format document."""
+    document = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': os.getenv('METRICS_NAMESPACE', 'OcpIamBroker'),
+                'Dimensions': [['Path']],
+                'Metrics': [{'Name': 'total', 'Unit': 'Milliseconds'}] +
+                           [{'Name': name, 'Unit': 'Milliseconds'} for name in sorted(invocation.timings)] +
+                           [{'Name': name, 'Unit': 'Count'} for name in sorted(invocation.counts)]
+            }]
+        },
+        'Path': invocation.path,
+        'total': round(total_ms, 3)
+    }
+    for name, milliseconds in invocation.timings.items():
+        document[name] = round(milliseconds, 3)
+    document.update(invocation.counts)
+    return document
+
+
+@contextlib.contextmanager
+def invocation(path: str):
+    """Collects the spans of one event, then writes them as a single metrics line (APP_METRICS) and, when the
+    invocation was slower than PROFILE_THRESHOLD_MS, its profile (APP_PROFILE)."""
+    current = Invocation(path)
+    token = _current.set(current)
+    profiler = cProfile.Profile() if os.getenv('APP_PROFILE', 'false') == 'true' else None
+    started = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield current
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        total_ms = (time.perf_counter() - started) * 1000
+        _current.reset(token)
+
+        if os.getenv('APP_METRICS', 'true') == 'true':
+            # Written straight to stdout, CloudWatch only extracts metrics from log lines which are plain JSON
+            sys.stdout.write(json.dumps(_emf(current, total_ms)) + '\n')
+            sys.stdout.flush()
+
+        if profiler is not None and total_ms > float(os.getenv('PROFILE_THRESHOLD_MS', 1000)):
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(
+                int(os.getenv('PROFILE_TOP', 30)))
+            _logger.warning('Slow %s invocation (%.1fms), profile:\n%s', path, total_ms, output.getvalue())
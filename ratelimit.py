@@ -0,0 +1,46 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+"""
+
+import cache
+import threading
+import time
+
+
+class TokenBucketLimiter:
+    """Token bucket per key: rate tokens per second, up to burst. Buckets are kept in a bounded LRU, a key which was
+    evicted starts again with a full bucket.
+
+    Lives at module scope in the callers so buckets survive across warm Lambda invocations."""
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 10000):
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.limited = 0
+        self._buckets = cache.LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def acquire(self, key) -> float:
+        """Takes a token for the key, returning 0 when allowed or else the seconds until a token is available."""
+        if not self.enabled():
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                self._buckets.put(key, (tokens - 1, now))
+                return 0.0
+            self._buckets.put(key, (tokens, now))
+            self.limited += 1
+            return (1 - tokens) / self.rate
@@ -0,0 +1,136 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Bulk cleanup of broker-authorization Secrets and Authorizations rows which the TTL and stream path left behind:
+
+  * Secrets without an Authorizations row (a missed or failed REMOVE record)
+  * Authorizations rows without their Secret
+  * per-pod Secrets (and their rows) no longer referenced by a running pod
+
+  Anything created or written within RECONCILE_GRACE_SECONDS is left alone so admissions in flight are not raced.
+"""
+
+import clients
+import logging
+import metrics
+import os
+import time
+import webhook
+
+_logger = logging.getLogger()
+_logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
+
+_TERMINAL_PHASES = ('Succeeded', 'Failed')
+
+
+@metrics.timed('list_secrets')
+def _list_secrets(v1) -> {}:
+    """Lists (paginated) the broker's Secrets, keyed by (namespace, name) with (creation time, shared)."""
+    secrets = {}
+    continue_token = None
+    while True:
+        resp = v1.list_secret_for_all_namespaces(limit=500, _continue=continue_token)
+        for secret in resp.items:
+            if secret.metadata.name.startswith(webhook._SECRET_PREFIX):
+                labels = secret.metadata.labels or {}
+                secrets[(secret.metadata.namespace, secret.metadata.name)] = (
+                    secret.metadata.creation_timestamp.timestamp(), webhook._SHARED_LABEL in labels)
+        continue_token = resp.metadata._continue
+        if not continue_token:
+            return secrets
+
+
+@metrics.timed('list_pods')
+def _list_referenced_secrets(v1) -> set:
+    """Lists (paginated) every pod which may still run, returning the (namespace, name) of the Secrets they use."""
+    referenced = set()
+    continue_token = None
+    while True:
+        resp = v1.list_pod_for_all_namespaces(limit=500, _continue=continue_token)
+        for pod in resp.items:
+            if pod.status is None or pod.status.phase not in _TERMINAL_PHASES:
+                referenced.update((pod.metadata.namespace, name) for name in webhook._pod_secret_names(pod))
+        continue_token = resp.metadata._continue
+        if not continue_token:
+            return referenced
+
+
+@metrics.timed('scan_authorizations')
+def _scan_authorizations() -> {}:
+    """Scans (paginated) the Authorizations table, keyed by auth_token with (namespace, secret_name, last written)."""
+    rows = {}
+    # expires is pushed out by EXPIRES_IN_DAYS on insert and on each last_accessed refresh
+    expires_days_in_seconds = int(os.getenv('EXPIRES_IN_DAYS', 14)) * 86400
+    paginator = clients.get_client('dynamodb').get_paginator('scan')
+    for page in paginator.paginate(TableName=os.getenv('AUTH_TABLE', 'role_perms'),
+                                   ProjectionExpression='auth_token, #n, secret_name, expires',
+                                   ExpressionAttributeNames={'#n': 'namespace'}):
+        for item in page['Items']:
+            written = int(item['expires']['N']) - expires_days_in_seconds if 'expires' in item else 0
+            rows[item['auth_token']['S']] = (item['namespace']['S'], item['secret_name']['S'], written)
+    return rows
+
+
+@metrics.timed('delete_authorizations')
+def _delete_authorizations(auth_tokens: []) -> int:
+    """Deletes the rows with up to RECONCILE_CONCURRENCY batches in flight, returning the number which failed."""
+    return len(webhook.delete_auth_rows(auth_tokens, int(os.getenv('RECONCILE_CONCURRENCY', 4))))
+
+
+def reconcile(dry_run: bool = False) -> dict:
+    v1 = webhook._core_api()
+    grace = float(os.getenv('RECONCILE_GRACE_SECONDS', 3600))
+
+    secrets = _list_secrets(v1)
+    referenced = _list_referenced_secrets(v1)
+    rows = _scan_authorizations()
+    now = time.time()
+
+    with_rows = set((namespace, secret_name) for namespace, secret_name, _ in rows.values())
+    # A row written within the grace period means the broker is still handing out its credentials
+    in_use = set((namespace, secret_name) for namespace, secret_name, written in rows.values()
+                 if now - written <= grace)
+    orphaned_secrets = set(
+        secret for secret, (created, shared) in secrets.items()
+        if now - created > grace and secret not in in_use and
+        (secret not in with_rows or (not shared and secret not in referenced)))
+    orphaned_rows = [
+        auth_token for auth_token, (namespace, secret_name, written) in rows.items()
+        if now - written > grace and ((namespace, secret_name) not in secrets or
+                                      (namespace, secret_name) in orphaned_secrets)]
+
+    summary = {
+        'dry_run': dry_run,
+        'secrets': len(secrets),
+        'authorizations': len(rows),
+        'orphaned_secrets': len(orphaned_secrets),
+        'orphaned_authorizations': len(orphaned_rows),
+        'failed_secrets': 0,
+        'failed_authorizations': 0
+    }
+    for namespace, secret_name in sorted(orphaned_secrets):
+        _logger.info('%s orphaned secret %s in namespace %s', 'Would remove' if dry_run else 'Removing',
+                     secret_name, namespace)
+
+    if not dry_run:
+        summary['failed_authorizations'] = _delete_authorizations(orphaned_rows)
+        with metrics.span('remove_secrets'):
+            summary['failed_secrets'] = len(webhook.remove_secrets(sorted(orphaned_secrets)))
+
+    metrics.count('orphaned_secrets', len(orphaned_secrets))
+    metrics.count('orphaned_authorizations', len(orphaned_rows))
+    _logger.info('Reconciled: %s', summary)
+    return summary
+
+
+def handler(options: dict) -> dict:
+    """Entry for the scheduled {"reconcile": {"dry_run": false}} event."""
+    options = options if isinstance(options, dict) else {}
+    return {'reconcile': reconcile(dry_run=str(options.get('dry_run', False)).lower() == 'true')}
@@ -0,0 +1,162 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Throttling-aware retries (full jitter) and circuit breaking around the broker's AWS calls. These calls are made with
+  single-attempt SDK clients (clients.get_client(..., sdk_retries=False)), so this is their only retry layer and the
+  breaker sees every attempt.
+"""
+
+import logging
+import metrics
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError as EndpointError, HTTPClientError
+
+_logger = logging.getLogger()
+_logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
+
+_THROTTLING_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'TransactionInProgressException',
+    'SlowDown'
+])
+
+_UNAVAILABLE_CODES = frozenset([
+    'InternalFailure',
+    'InternalServerError',
+    'ServiceUnavailable',
+    'ServiceUnavailableException',
+    'RequestTimeout',
+    'RequestTimeoutException'
+])
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a service whose breaker is open."""
+
+    def __init__(self, name: str, retry_after: float):
+        super().__init__('Circuit breaker %s is open, retry after %.1fs' % (name, retry_after))
+        self.name = name
+        self.retry_after = retry_after
+
+
+def is_throttling(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in _THROTTLING_CODES
+
+
+def _is_failure(error: Exception) -> bool:
+    """Errors telling about the health of the service (as opposed to the request, e.g. AccessDenied)."""
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code')
+        return code in _THROTTLING_CODES or code in _UNAVAILABLE_CODES
+    return isinstance(error, (EndpointError, HTTPClientError))
+
+
+class CircuitBreaker:
+    """Opens after BREAKER_FAILURE_THRESHOLD consecutive throttles/failures, rejecting calls for BREAKER_RESET_SECONDS.
+    Then lets a single trial call through (half-open), closing again on its success. Transitions are logged."""
+
+    def __init__(self, name: str, failure_threshold: int = None, reset_seconds: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold if failure_threshold is not None else \
+            int(os.getenv('BREAKER_FAILURE_THRESHOLD', 5))
+        self.reset_seconds = reset_seconds if reset_seconds is not None else \
+            float(os.getenv('BREAKER_RESET_SECONDS', 30))
+        self.state = CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _transition(self, state: str) -> None:
+        _logger.warning('Circuit breaker %s: %s -> %s after %d consecutive failures', self.name, self.state, state,
+                        self.failures)
+        self.state = state
+
+    def before_call(self) -> None:
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if self.state == OPEN and remaining <= 0:
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+        metrics.count('breaker_rejected_' + self.name)
+        raise CircuitOpen(self.name, max(remaining, 1.0))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._trial_in_flight = False
+            if self.state != CLOSED:
+                self._transition(CLOSED)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and 0 < self.failure_threshold <= self.failures):
+                self._opened_at = time.monotonic()
+                self._transition(OPEN)
+
+    def retry_after(self) -> int:
+        """Seconds a client should wait: until the trial call when open, otherwise a jittered 1-RETRY_AFTER_SECONDS so
+        throttled callers do not come back in step."""
+        with self._lock:
+            if self.state == OPEN:
+                return max(1, int(self._opened_at + self.reset_seconds - time.monotonic() + 0.999))
+        return random.randint(1, max(1, int(os.getenv('RETRY_AFTER_SECONDS', 5))))
+
+
+def _backoff(attempt: int) -> float:
+    """Full jitter: a uniform delay up to the exponentially growing (and capped) backoff."""
+    base = float(os.getenv('THROTTLE_BACKOFF_BASE_MS', 50)) / 1000
+    cap = float(os.getenv('THROTTLE_BACKOFF_MAX_MS', 1000)) / 1000
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call(breaker: CircuitBreaker, function, *args, **kwargs):
+    """Calls function through the breaker, retrying throttling and unavailability errors (up to
+    THROTTLE_RETRY_ATTEMPTS attempts) with full jitter backoff. Other errors are raised straight away."""
+    attempts = max(1, int(os.getenv('THROTTLE_RETRY_ATTEMPTS', 3)))
+    for attempt in range(attempts):
+        breaker.before_call()
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            if not _is_failure(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if is_throttling(e):
+                metrics.count('throttled_' + breaker.name)
+            if attempt + 1 >= attempts:
+                raise
+            time.sleep(_backoff(attempt))
+            continue
+        breaker.record_success()
+        return result
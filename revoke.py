@@ -0,0 +1,156 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Bulk revocation of the authorizations issued to a namespace, a namespace's service account or for a role ARN.
+  The matching tokens are found through the Authorizations table's secondary indexes, so the cost follows the number
+  of matching rows rather than the size of the table. Deleting the rows revokes the tokens straight away (the broker
+  reads the row on every request); the stream REMOVE records then remove their Secrets.
+
+  The generation of the matching Allowances rows is bumped first. Shared Secrets (SHARE_AUTHORIZATIONS) are named after
+  it, so every webhook instance mints a new one as soon as its Allowances index sees the change, rather than handing out
+  a revoked Secret (or bringing its row back) until the end of the rotation period.
+"""
+
+import clients
+import logging
+import metrics
+import os
+import webhook
+
+from botocore.exceptions import ClientError
+
+_logger = logging.getLogger()
+_logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
+
+
+def _query_arguments(namespace: str, service_account: str, role_arn: str) -> dict:
+    """The Query (index, key condition and filter) selecting the authorizations to revoke."""
+    if service_account is not None and namespace is None:
+        raise ValueError('A service_account can only be revoked within a namespace')
+
+    if namespace is not None:
+        arguments = {
+            'IndexName': os.getenv('AUTH_NAMESPACE_INDEX', 'namespace-service_account-index'),
+            'KeyConditionExpression': '#n = :namespace',
+            'ExpressionAttributeNames': {'#n': 'namespace'},
+            'ExpressionAttributeValues': {':namespace': {'S': namespace}}
+        }
+        if service_account is not None:
+            arguments['KeyConditionExpression'] += ' AND service_account = :service_account'
+            arguments['ExpressionAttributeValues'][':service_account'] = {'S': service_account}
+        if role_arn is not None:
+            # role_arn is projected into the namespace index for this filter
+            arguments['FilterExpression'] = 'role_arn = :role_arn'
+            arguments['ExpressionAttributeValues'][':role_arn'] = {'S': role_arn}
+        return arguments
+
+    if role_arn is not None:
+        return {
+            'IndexName': os.getenv('AUTH_ROLE_INDEX', 'role_arn-index'),
+            'KeyConditionExpression': 'role_arn = :role_arn',
+            'ExpressionAttributeValues': {':role_arn': {'S': role_arn}}
+        }
+
+    raise ValueError('One of namespace or role_arn is required')
+
+
+@metrics.timed('query_authorizations')
+def _query_authorizations(arguments: dict) -> []:
+    """Queries (paginated) the index, returning the matching auth tokens."""
+    auth_tokens = []
+    paginator = clients.get_client('dynamodb').get_paginator('query')
+    for page in paginator.paginate(TableName=os.getenv('AUTH_TABLE', 'role_perms'),
+                                   ProjectionExpression='auth_token', **arguments):
+        auth_tokens.extend(item['auth_token']['S'] for item in page['Items'])
+    return auth_tokens
+
+
+def _allowance_keys(namespace: str, service_account: str, role_arn: str) -> []:
+    """The (namespace, service_account) of the Allowances rows covering the revoked authorizations."""
+    if namespace is not None and service_account is not None:
+        return [(namespace, service_account)]
+
+    dynamo = clients.get_client('dynamodb')
+    arguments = {'TableName': os.getenv('MAP_TABLE', 'mapped_roles'), 'ProjectionExpression': '#n, service_account',
+                 'ExpressionAttributeNames': {'#n': 'namespace'}, 'ExpressionAttributeValues': {}}
+    if role_arn is not None:
+        arguments['FilterExpression'] = 'contains(allowed_roles, :role_arn)'
+        arguments['ExpressionAttributeValues'][':role_arn'] = {'S': role_arn}
+    if namespace is not None:
+        arguments['KeyConditionExpression'] = '#n = :namespace'
+        arguments['ExpressionAttributeValues'][':namespace'] = {'S': namespace}
+        pages = dynamo.get_paginator('query').paginate(**arguments)
+    else:
+        # Only a role: the Allowances table is small, and scanned in full by the webhooks anyway
+        pages = dynamo.get_paginator('scan').paginate(**arguments)
+    return [(item['namespace']['S'], item['service_account']['S']) for page in pages for item in page['Items']]
+
+
+@metrics.timed('bump_generations')
+def _bump_generations(keys: []) -> int:
+    """Increments the generation of the Allowances rows, returning the number which could not be updated."""
+    failed = 0
+    for namespace, service_account in keys:
+        try:
+            clients.get_client('dynamodb').update_item(
+                TableName=os.getenv('MAP_TABLE', 'mapped_roles'),
+                Key={'namespace': {'S': namespace}, 'service_account': {'S': service_account}},
+                UpdateExpression='ADD generation :one',
+                ConditionExpression='attribute_exists(service_account)',
+                ExpressionAttributeValues={':one': {'N': '1'}})
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                _logger.error('Unable to bump the generation of %s/%s: %s', namespace, service_account, e)
+                failed += 1
+    return failed
+
+
+@metrics.timed('delete_authorizations')
+def _delete_authorizations(auth_tokens: []) -> []:
+    """Deletes the rows with up to REVOKE_CONCURRENCY batches in flight, returning the tokens which failed."""
+    return webhook.delete_auth_rows(auth_tokens, int(os.getenv('REVOKE_CONCURRENCY', 4)))
+
+
+def revoke(namespace: str = None, service_account: str = None, role_arn: str = None, dry_run: bool = False) -> dict:
+    auth_tokens = _query_authorizations(_query_arguments(namespace, service_account, role_arn))
+
+    summary = {
+        'dry_run': dry_run,
+        'namespace': namespace,
+        'service_account': service_account,
+        'role_arn': role_arn,
+        'authorizations': len(auth_tokens),
+        'failed_allowances': 0,
+        'failed_authorizations': 0
+    }
+    if not dry_run:
+        summary['failed_allowances'] = _bump_generations(_allowance_keys(namespace, service_account, role_arn))
+        failed = _delete_authorizations(auth_tokens)
+        summary['failed_authorizations'] = len(failed)
+        if len(failed) > 0:
+            _logger.error('Failed to revoke %d of %d authorizations', len(failed), len(auth_tokens))
+
+    metrics.count('revoked_authorizations', 0 if dry_run else len(auth_tokens) - summary['failed_authorizations'])
+    _logger.info('%s: %s', 'Would revoke' if dry_run else 'Revoked', summary)
+    return summary
+
+
+def handler(options: dict) -> dict:
+    """Entry for the {"revoke": {"namespace": ..., "service_account": ..., "role_arn": ..., "dry_run": false}}
+    event."""
+    options = options if isinstance(options, dict) else {}
+    try:
+        return {'revoke': revoke(namespace=options.get('namespace'),
+                                 service_account=options.get('service_account'),
+                                 role_arn=options.get('role_arn'),
+                                 dry_run=str(options.get('dry_run', False)).lower() == 'true')}
+    except ValueError as e:
+        _logger.error('Invalid revocation %s: %s', options, e)
+        return {'revoke': {'error': str(e)}}
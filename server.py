@@ -0,0 +1,235 @@
+"""
+  Licensed under the Apache License, Version 2.0 (the "License").
+  You may not use this file except in compliance with the License.
+  A copy of the License is located at
+      http://www.apache.org/licenses/LICENSE-2.0
+  or in the "license" file accompanying this file. This file is distributed
+  on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+  express or implied. See the License for the specific language governing
+  permissions and limitations under the License.
+
+  Long-running HTTP server for the broker (GET) and webhook (POST) endpoints, as an alternative to API Gateway and
+  Lambda. Requests are translated into the same events index.handler receives from API Gateway, so both paths share
+  their semantics, while caches and connection pools stay warm for the life of the process.
+
+      $ python server.py
+"""
+
+import asyncio
+import concurrent.futures
+import http
+import json
+import logging
+import os
+import signal
+import ssl
+
+import index
+
+_logger = logging.getLogger()
+_logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
+
+_MAX_HEADER_COUNT = 100
+_MAX_BODY_BYTES = 4 * 1024 * 1024
+
+
+class _BadRequest(Exception):
+    pass
+
+
+def _canonical(name: str) -> str:
+    """Header names as API Gateway forwards them to the handlers, e.g. authorization -> Authorization."""
+    return '-'.join(part.capitalize() for part in name.split('-'))
+
+
+def _response_bytes(status: int, headers: dict, body: bytes, keep_alive: bool) -> bytes:
+    try:
+        reason = http.HTTPStatus(status).phrase
+    except ValueError:
+        reason = ''
+    lines = ['HTTP/1.1 %d %s' % (status, reason)]
+    for name, value in headers.items():
+        lines.append('%s: %s' % (name, value))
+    lines.append('Content-Length: %d' % len(body))
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+class Server:
+
+    def __init__(self):
+        self.keepalive_timeout = float(os.getenv('SERVER_KEEPALIVE_TIMEOUT', 75))
+        self.shutdown_timeout = float(os.getenv('SERVER_SHUTDOWN_TIMEOUT', 25))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv('SERVER_WORKERS', 64)),
+                                                              thread_name_prefix='request')
+        self.servers = []
+        self.connections = {}
+        self.stopping = None
+
+    async def _read_request(self, reader: asyncio.StreamReader):
+        request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise _BadRequest('Malformed request line')
+        method, target, version = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= _MAX_HEADER_COUNT or b':' not in line:
+                raise _BadRequest('Malformed headers')
+            name, value = line.decode('latin-1').split(':', 1)
+            headers[_canonical(name.strip())] = value.strip()
+
+        body = b''
+        if headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                body += await reader.readexactly(size + 2)
+                body = body[:-2]
+                if len(body) > _MAX_BODY_BYTES:
+                    raise _BadRequest('Body too large')
+        elif 'Content-Length' in headers:
+            length = int(headers['Content-Length'])
+            if length > _MAX_BODY_BYTES:
+                raise _BadRequest('Body too large')
+            body = await reader.readexactly(length)
+
+        keep_alive = headers.get('Connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        return method, target.split('?', 1)[0], headers, body.decode('utf-8'), keep_alive
+
+    async def _dispatch(self, method: str, path: str, headers: dict, body: str, peer: str):
+        if method == 'GET' and path == '/healthz':
+            return 200, {'Content-Type': 'text/plain'}, b'ok'
+
+        event = {
+            'httpMethod': method,
+            'path': path,
+            'headers': headers,
+            'body': body,
+            'requestContext': {'identity': {'sourceIp': peer}}
+        }
+        result = await asyncio.get_running_loop().run_in_executor(self.executor, index.handler, event, None)
+        response_body = result.get('body', '')
+        if not isinstance(response_body, str):
+            response_body = json.dumps(response_body)
+        return result.get('statusCode', 200), result.get('headers', {}), response_body.encode('utf-8')
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections[task] = False
+        peer = (writer.get_extra_info('peername') or ('',))[0]
+        try:
+            while not self.stopping.is_set():
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except (_BadRequest, ValueError) as e:
+                    writer.write(_response_bytes(400, {'Content-Type': 'text/plain'}, str(e).encode('utf-8'), False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+
+                method, path, headers, body, keep_alive = request
+                self.connections[task] = True
+                try:
+                    status, response_headers, response_body = await self._dispatch(method, path, headers, body,
+                                                                                   peer)
+                except Exception as e:
+                    _logger.error('Unhandled exception serving %s %s: %s', method, path, e)
+                    status, response_headers, response_body = 500, {'Content-Type': 'text/plain'}, b'Server Error'
+                finally:
+                    self.connections[task] = False
+
+                keep_alive = keep_alive and not self.stopping.is_set()
+                writer.write(_response_bytes(status, response_headers, response_body, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    async def start(self, host: str = None, port: int = None, tls_port: int = None) -> None:
+        self.stopping = asyncio.Event()
+        host = host if host is not None else os.getenv('SERVER_HOST', '0.0.0.0')
+        port = port if port is not None else int(os.getenv('SERVER_PORT', 8080))
+        if port >= 0:
+            self.servers.append(await asyncio.start_server(self._handle_connection, host, port))
+
+        # The admission webhook must be served over TLS, the broker endpoint can be plain or TLS
+        if os.getenv('SERVER_TLS_CERT') and os.getenv('SERVER_TLS_KEY'):
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(os.getenv('SERVER_TLS_CERT'), os.getenv('SERVER_TLS_KEY'))
+            tls_port = tls_port if tls_port is not None else int(os.getenv('SERVER_TLS_PORT', 8443))
+            self.servers.append(await asyncio.start_server(self._handle_connection, host, tls_port, ssl=context))
+
+        for server in self.servers:
+            _logger.info('Listening on %s', ', '.join(str(socket.getsockname()) for socket in server.sockets))
+
+    def ports(self) -> []:
+        return [server.sockets[0].getsockname()[1] for server in self.servers]
+
+    async def shutdown(self) -> None:
+        """Stops accepting connections, lets in-flight requests finish (up to SERVER_SHUTDOWN_TIMEOUT) and closes
+        idle keep-alive connections."""
+        self.stopping.set()
+        for server in self.servers:
+            server.close()
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.shutdown_timeout
+        while any(self.connections.values()) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for task in list(self.connections):
+            task.cancel()
+        if self.connections:
+            await asyncio.gather(*self.connections, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.executor.shutdown(wait=True)
+
+        import broker
+        broker.flush_refreshes(self.shutdown_timeout)
+
+    async def run(self) -> None:
+        await self.start()
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+        _logger.info('Shutting down')
+        await self.shutdown()
+
+
+def main() -> None:
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    try:
+        index.warmup()
+    except Exception as e:
+        _logger.error('Warm-up failed, continuing: %s', e)
+    if os.getenv('SA_WATCH', 'false') == 'true':
+        import webhook
+        webhook.start_service_account_watch()
+    if os.getenv('POD_WATCH', 'false') == 'true':
+        import webhook
+        webhook.start_pod_watch()
+    asyncio.run(Server().run())
+
+
+if __name__ == '__main__':
+    main()
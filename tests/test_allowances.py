@@ -0,0 +1,55 @@
+import unittest
+from unittest import mock
+
+import allowances
+
+
+def _item(namespace, service_account, *roles):
+    return {
+        'namespace': {'S': namespace},
+        'service_account': {'S': service_account},
+        'allowed_roles': {'SS': list(roles)}
+    }
+
+
+class TestAllowancesCase(unittest.TestCase):
+
+    def setUp(self):
+        allowances.invalidate()
+        self.dynamo = mock.Mock()
+        self.dynamo.get_paginator.return_value.paginate.return_value = [
+            {'Items': [_item('app1', 'app-sa', 'arn:aws:iam::111111111111:role/a')]},
+            {'Items': [_item('app2', 'app-sa', 'arn:aws:iam::111111111111:role/b')]}
+        ]
+        patcher = mock.patch('clients.get_client', return_value=self.dynamo)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(allowances.invalidate)
+
+    def test_lookup_loads_once(self):
+        self.assertEqual(allowances.get_allowed_arns('app1', 'app-sa'), ['arn:aws:iam::111111111111:role/a'])
+        self.assertEqual(allowances.get_allowed_arns('app2', 'app-sa'), ['arn:aws:iam::111111111111:role/b'])
+        self.assertIsNone(allowances.get_allowed_arns('app1', 'other'))
+        self.assertTrue(allowances.namespace_has_allowances('app1'))
+        self.assertFalse(allowances.namespace_has_allowances('kube-system'))
+        self.assertEqual(self.dynamo.get_paginator.return_value.paginate.call_count, 1)
+
+    def test_stream_records(self):
+        arn = 'arn:aws:dynamodb:us-east-2:111111111111:table/mapped_roles/stream/2020-01-01T00:00:00.000'
+        allowances.get_allowance('app1', 'app-sa')
+
+        insert = {'eventName': 'INSERT', 'eventSourceARN': arn,
+                  'dynamodb': {'NewImage': _item('app3', 'app-sa', 'arn:aws:iam::111111111111:role/c')}}
+        remove = {'eventName': 'REMOVE', 'eventSourceARN': arn,
+                  'dynamodb': {'Keys': {'namespace': {'S': 'app1'}, 'service_account': {'S': 'app-sa'}}}}
+        self.assertTrue(allowances.is_allowances_record(insert))
+        allowances.apply_stream_record(insert)
+        allowances.apply_stream_record(remove)
+
+        self.assertEqual(allowances.get_allowed_arns('app3', 'app-sa'), ['arn:aws:iam::111111111111:role/c'])
+        self.assertFalse(allowances.namespace_has_allowances('app1'))
+        self.assertFalse(allowances.is_allowances_record({'eventSourceARN': arn.replace('mapped_roles', 'role_perms')}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+import bench_revoke  # noqa: E402
+import run  # noqa: E402
+
+
+class TestBenchmarksCase(unittest.TestCase):
+
+    def test_scenarios(self):
+        for name in run.SCENARIOS:
+            result = run.run_scenario(name, 8, {})
+            self.assertGreater(result['requests'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+    def test_pod_storm_reads_service_account_once(self):
+        requests = 20
+        result = run.run_scenario('pod-storm', requests, {})
+        # Concurrent misses wait on the in-flight read, so at most one read for the whole storm
+        reads = result['calls_per_request']['kubernetes.read_namespaced_service_account'] * requests
+        self.assertLessEqual(round(reads), 1)
+
+    def test_revoke_reads_only_matching_rows(self):
+        small = bench_revoke.measure(1000, 30)
+        large = bench_revoke.measure(5000, 30)
+        self.assertEqual(small['query_rows_read'], large['query_rows_read'])
+        self.assertEqual(small['query_calls'], large['query_calls'])
+        self.assertGreater(large['scan_calls'], small['scan_calls'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,11 @@
+import datetime
 import unittest
+from unittest import mock
+
 import broker
 
+from botocore.exceptions import ClientError
+
 
 class TestHandlerCase(unittest.TestCase):
 
@@ -12,6 +17,164 @@ class TestHandlerCase(unittest.TestCase):
         self.assertEqual(result['headers']['Content-Type'], 'application/json')
         self.assertIn('Not Authorized', result['body'])
 
+    def test_credential_cache(self):
+        broker._credential_cache.clear()
+        hits = broker._credential_cache.hits
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=900)
+        sts = mock.Mock()
+        sts.assume_role.return_value = {'Credentials': {
+            'AccessKeyId': 'AKID', 'SecretAccessKey': 'SECRET', 'SessionToken': 'TOKEN', 'Expiration': expiration
+        }}
+
+        with mock.patch('broker._get_authorization',
+                           return_value={'role_arn': {'S': 'arn:aws:iam::111111111111:role/test'}}), \
+                mock.patch('clients.get_client', return_value=sts):
+            first, first_age = broker._get_credentials('abc')
+            second, second_age = broker._get_credentials('abc')
+
+        self.assertEqual(sts.assume_role.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertTrue(0 < second_age <= first_age <= 600)
+        self.assertEqual(broker._credential_cache.hits, hits + 1)
+
+    def test_last_accessed_refresh_suppressed(self):
+        dynamo = mock.Mock()
+        recent = str(int(datetime.datetime.now().timestamp()) - 60)
+        stale = str(int(datetime.datetime.now().timestamp()) - 7200)
+        item = {'auth_token': {'S': 'abc'}, 'role_arn': {'S': 'arn:aws:iam::111111111111:role/test'}}
+
+        with mock.patch('clients.get_client', return_value=dynamo):
+            dynamo.get_item.return_value = {'Item': dict(item, last_accessed={'N': recent})}
+            self.assertEqual(broker._get_arn('abc'), 'arn:aws:iam::111111111111:role/test')
+            self.assertEqual(dynamo.update_item.call_count, 0)
+
+            dynamo.get_item.return_value = {'Item': dict(item, last_accessed={'N': stale})}
+            broker._get_arn('abc')
+            self.assertEqual(dynamo.update_item.call_count, 1)
+
+            with mock.patch.dict('os.environ', {'LAST_ACCESSED_WRITE_MODE': 'deferred'}):
+                broker._get_arn('abc')
+                broker.flush_refreshes(5)
+            self.assertEqual(dynamo.update_item.call_count, 2)
+
+    def test_unknown_token(self):
+        dynamo = mock.Mock()
+        dynamo.get_item.return_value = {}
+        with mock.patch('clients.get_client', return_value=dynamo):
+            self.assertIsNone(broker._get_arn('missing'))
+        dynamo.update_item.assert_not_called()
+
+    def test_cache_control_allows_stale(self):
+        with mock.patch('broker._get_credentials', return_value=({'AccessKeyId': 'AKID'}, 500)):
+            result = broker.handler({'headers': {'Authorization': 'abc'}}, None)
+
+        self.assertEqual(result['statusCode'], 200)
+        self.assertEqual(result['headers']['Cache-control'],
+                         'max-age=500, stale-while-revalidate=60, stale-if-error=240')
+
+    def test_session_duration(self):
+        role = 'arn:aws:iam::111111111111:role/long'
+        broker._role_duration_caps.clear()
+        self.assertEqual(broker._session_duration({'role_arn': {'S': role}}), 900)
+        self.assertEqual(broker._session_duration({'role_arn': {'S': role}, 'duration': {'N': '3600'}}), 3600)
+        self.assertEqual(broker._session_duration({'role_arn': {'S': role}, 'duration': {'N': '43200'}}), 3600)
+        # Below the STS minimum, which AssumeRole would refuse
+        self.assertEqual(broker._session_duration({'role_arn': {'S': role}, 'duration': {'N': '600'}}), 900)
+        with mock.patch.dict('os.environ', {'DEFAULT_DURATION': '300'}):
+            self.assertEqual(broker._session_duration({'role_arn': {'S': role}}), 900)
+
+        sts = mock.Mock()
+        sts.assume_role.side_effect = [
+            ClientError({'Error': {'Code': 'ValidationError', 'Message': 'too long'}}, 'AssumeRole'),
+            {'Credentials': {}}
+        ]
+        with mock.patch('clients.get_client', return_value=sts):
+            broker._assume_role(role, 3600, 'abc')
+
+        self.assertEqual(sts.assume_role.call_args[1]['DurationSeconds'], 900)
+        self.assertEqual(broker._session_duration({'role_arn': {'S': role}, 'duration': {'N': '3600'}}), 900)
+        broker._role_duration_caps.clear()
+
+    def test_refused_duration_steps_down(self):
+        role = 'arn:aws:iam::111111111111:role/two-hours'
+        broker._role_duration_caps.clear()
+        self.addCleanup(broker._role_duration_caps.clear)
+
+        def assume_role(RoleArn, DurationSeconds, RoleSessionName):
+            if DurationSeconds > 7200:
+                raise ClientError({'Error': {'Code': 'ValidationError', 'Message': 'too long'}}, 'AssumeRole')
+            return {'Credentials': {}}
+
+        sts = mock.Mock()
+        sts.assume_role.side_effect = assume_role
+        with mock.patch('clients.get_client', return_value=sts):
+            broker._assume_role(role, 43200, 'abc')
+
+        self.assertEqual([call[1]['DurationSeconds'] for call in sts.assume_role.call_args_list],
+                         [43200, 21600, 10800, 5400])
+        self.assertEqual(broker._role_duration_caps[role], 5400)
+
+    def test_throttling_opens_breaker(self):
+        throttled = ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, 'AssumeRole')
+        sts = mock.Mock()
+        sts.assume_role.side_effect = throttled
+        breakers = {'dynamodb': broker.resilience.CircuitBreaker('dynamodb'),
+                    'sts': broker.resilience.CircuitBreaker('sts', failure_threshold=2, reset_seconds=30)}
+        broker._credential_cache.clear()
+
+        with mock.patch('broker._breakers', breakers), \
+                mock.patch('broker._get_authorization',
+                           return_value={'role_arn': {'S': 'arn:aws:iam::111111111111:role/test'}}), \
+                mock.patch('clients.get_client', return_value=sts), mock.patch('time.sleep'):
+            throttled_result = broker.handler({'headers': {'Authorization': 'abc'}}, None)
+            open_result = broker.handler({'headers': {'Authorization': 'abc'}}, None)
+
+        # Two attempts for the first request, none for the second
+        self.assertEqual(sts.assume_role.call_count, 2)
+        self.assertEqual(throttled_result['statusCode'], 503)
+        self.assertEqual(open_result['statusCode'], 503)
+        self.assertTrue(1 <= int(open_result['headers']['Retry-After']) <= 30)
+        self.assertEqual(breakers['sts'].state, 'open')
+
+    def test_unknown_token_negative_cache(self):
+        broker._unknown_tokens.clear()
+        dynamo = mock.Mock()
+        dynamo.get_item.return_value = {}
+        with mock.patch('clients.get_client', return_value=dynamo):
+            first = broker.handler({'headers': {'Authorization': 'revoked'}}, None)
+            second = broker.handler({'headers': {'Authorization': 'revoked'}}, None)
+
+        self.assertEqual(first['statusCode'], 404)
+        self.assertEqual(second['statusCode'], 404)
+        self.assertEqual(first['headers']['Cache-control'], 'max-age=30')
+        self.assertEqual(dynamo.get_item.call_count, 1)
+
+    def test_rate_limited(self):
+        limiter = broker.ratelimit.TokenBucketLimiter(1, 2)
+        event = {'headers': {'Authorization': 'abc'}, 'requestContext': {'identity': {'sourceIp': '10.0.0.1'}}}
+        with mock.patch('broker._token_limiter', limiter), \
+                mock.patch('broker._get_credentials', return_value=({'AccessKeyId': 'AKID'}, 500)):
+            statuses = [broker.handler(event, None)['statusCode'] for _ in range(3)]
+            limited = broker.handler(event, None)
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(limited['headers']['Retry-After'], '1')
+        self.assertEqual(limited['headers']['Cache-control'], 'max-age=1')
+
+        sources = broker.ratelimit.TokenBucketLimiter(1, 1)
+        with mock.patch('broker._source_limiter', sources), \
+                mock.patch('broker._get_credentials', return_value=({'AccessKeyId': 'AKID'}, 500)):
+            self.assertEqual(broker.handler(dict(event, headers={'Authorization': 'one'}), None)['statusCode'], 200)
+            self.assertEqual(broker.handler(dict(event, headers={'Authorization': 'two'}), None)['statusCode'], 429)
+
+    def test_shared_token_burst_not_limited(self):
+        # With SHARE_AUTHORIZATIONS every replica refreshes one token as its cached credential expires
+        event = {'headers': {'Authorization': 'shared'}, 'requestContext': {'identity': {'sourceIp': '10.0.0.1'}}}
+        with mock.patch('broker._get_credentials', return_value=({'AccessKeyId': 'AKID'}, 500)):
+            statuses = set(broker.handler(event, None)['statusCode'] for _ in range(150))
+
+        self.assertEqual(statuses, {200})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from unittest import mock
+
+import clients
+
+
+class TestClientsCase(unittest.TestCase):
+
+    def setUp(self):
+        clients.reset()
+
+    def tearDown(self):
+        clients.reset()
+
+    def test_client_reused(self):
+        with mock.patch('boto3.client', side_effect=lambda name, config: mock.Mock(name=name)) as factory:
+            first = clients.get_client('dynamodb')
+            second = clients.get_client('dynamodb')
+            sts = clients.get_client('sts')
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, sts)
+        self.assertEqual(factory.call_count, 2)
+
+    def test_client_config_from_env(self):
+        with mock.patch.dict('os.environ', {'CLIENT_MAX_POOL_CONNECTIONS': '25', 'CLIENT_MAX_ATTEMPTS': '5'}):
+            config = clients._client_config()
+
+        self.assertEqual(config.max_pool_connections, 25)
+        self.assertEqual(config.retries['max_attempts'], 5)
+        self.assertTrue(config.tcp_keepalive)
+
+    def test_single_attempt_client(self):
+        with mock.patch('boto3.client', side_effect=lambda name, config: mock.Mock(config=config)):
+            retrying = clients.get_client('sts')
+            single = clients.get_client('sts', sdk_retries=False)
+
+        self.assertIsNot(retrying, single)
+        self.assertEqual(retrying.config.retries['max_attempts'], 3)
+        self.assertEqual(single.config.retries['max_attempts'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+from unittest import mock
+
+import index
+
+from kubernetes.client.rest import ApiException
+
+
+class TestIndexCase(unittest.TestCase):
+
+    def test_broker_path_skips_webhook_imports(self):
+        script = ("import sys, index; index.handler({'httpMethod': 'GET', 'headers': {}}, None); "
+                  "print('kubernetes' in sys.modules, 'webhook' in sys.modules)")
+        output = subprocess.check_output([sys.executable, '-c', script], universal_newlines=True,
+                                         cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         env=dict(os.environ, APP_METRICS='false'))
+        self.assertEqual(output.split(), ['False', 'False'])
+
+    def test_warmup(self):
+        with mock.patch('clients.get_client') as get_client, \
+                mock.patch('webhook._get_kube_config') as get_kube_config:
+            result = index.handler({'warmup': True}, None)
+
+        # The shared clients plus the broker's single-attempt DynamoDB & STS clients
+        self.assertEqual(get_client.call_count, 5)
+        get_kube_config.assert_called_once()
+        self.assertIn('kube_config_ms', result['warmup'])
+        json.dumps(result)
+
+    def test_remove_records_report_failures(self):
+        def record(sequence_number, secret_name):
+            return {'eventName': 'REMOVE', 'eventSourceARN': 'arn:aws:dynamodb:::table/role_perms/stream/1',
+                    'dynamodb': {'SequenceNumber': sequence_number, 'OldImage': {
+                        'namespace': {'S': 'app1'}, 'secret_name': {'S': secret_name}}}}
+
+        def delete_secret(name, namespace):
+            if name == 'gone':
+                raise ApiException(status=404)
+            if name == 'broken':
+                raise ApiException(status=500)
+
+        v1 = mock.Mock()
+        v1.delete_namespaced_secret.side_effect = delete_secret
+        with mock.patch('webhook._get_kube_config'), mock.patch('kubernetes.client.CoreV1Api', return_value=v1):
+            result = index.handler({'Records': [record('1', 'ok'), record('2', 'gone'), record('3', 'broken')]}, None)
+
+        self.assertEqual(result, {'batchItemFailures': [{'itemIdentifier': '3'}]})
+        self.assertEqual(v1.delete_namespaced_secret.call_count, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
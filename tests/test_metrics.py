@@ -0,0 +1,45 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+import metrics
+
+
+class TestMetricsCase(unittest.TestCase):
+
+    def test_single_emf_line(self):
+        output = io.StringIO()
+        with mock.patch('sys.stdout', output):
+            with metrics.invocation('broker'):
+                with metrics.span('assume_role'):
+                    pass
+                with metrics.span('assume_role'):
+                    pass
+                metrics.count('credential_cache_hit')
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 1)
+        document = json.loads(lines[0])
+        self.assertEqual(document['Path'], 'broker')
+        self.assertIn('assume_role', document)
+        self.assertEqual(document['credential_cache_hit'], 1)
+        names = [metric['Name'] for metric in document['_aws']['CloudWatchMetrics'][0]['Metrics']]
+        self.assertEqual(names, ['total', 'assume_role', 'credential_cache_hit'])
+
+    def test_span_outside_invocation(self):
+        with metrics.span('ignored'):
+            pass
+
+    def test_slow_invocation_profiled(self):
+        with mock.patch.dict('os.environ', {'APP_PROFILE': 'true', 'PROFILE_THRESHOLD_MS': '0',
+                                            'APP_METRICS': 'false'}), \
+                self.assertLogs(level='WARNING') as logs:
+            with metrics.invocation('webhook'):
+                sum(range(1000))
+
+        self.assertIn('profile', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
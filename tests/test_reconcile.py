@@ -0,0 +1,95 @@
+import datetime
+import time
+import unittest
+from unittest import mock
+
+import index
+import reconcile
+
+from kubernetes import client
+
+
+def _secret(namespace, name, age, shared=False):
+    created = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=age)
+    return client.V1Secret(metadata=client.V1ObjectMeta(
+        name=name, namespace=namespace, creation_timestamp=created,
+        labels={'ocp-iam-broker/shared': 'true'} if shared else None))
+
+
+def _pod(namespace, secret_name, phase='Running'):
+    env = client.V1EnvVar(name='AWS_CONTAINER_AUTHORIZATION_TOKEN', value_from=client.V1EnvVarSource(
+        secret_key_ref=client.V1SecretKeySelector(name=secret_name, key='AWS_CONTAINER_AUTHORIZATION_TOKEN')))
+    return client.V1Pod(metadata=client.V1ObjectMeta(name='pod', namespace=namespace),
+                        spec=client.V1PodSpec(containers=[client.V1Container(name='app', env=[env])]),
+                        status=client.V1PodStatus(phase=phase))
+
+
+def _page(items, continue_token=None):
+    return mock.Mock(items=items, metadata=mock.Mock(_continue=continue_token))
+
+
+def _row(auth_token, namespace, secret_name, age):
+    return {'auth_token': {'S': auth_token}, 'namespace': {'S': namespace}, 'secret_name': {'S': secret_name},
+            'expires': {'N': str(int(time.time()) - age + 14 * 86400)}}
+
+
+class TestReconcileCase(unittest.TestCase):
+
+    def setUp(self):
+        self.v1 = mock.Mock()
+        self.v1.list_secret_for_all_namespaces.side_effect = [
+            _page([_secret('app1', 'broker-authorization-used', 7200),
+                   _secret('app1', 'broker-authorization-norow', 7200),
+                   _secret('app1', 'unrelated', 7200)], 'next'),
+            _page([_secret('app1', 'broker-authorization-podgone', 7200),
+                   _secret('app1', 'broker-authorization-shared', 7200, shared=True),
+                   _secret('app1', 'broker-authorization-new', 60)])]
+        self.v1.list_pod_for_all_namespaces.return_value = _page([
+            _pod('app1', 'broker-authorization-used'),
+            _pod('app1', 'broker-authorization-podgone', phase='Succeeded')])
+
+        self.dynamo = mock.Mock()
+        self.dynamo.get_paginator.return_value.paginate.return_value = [{'Items': [
+            _row('used', 'app1', 'broker-authorization-used', 7200),
+            _row('podgone', 'app1', 'broker-authorization-podgone', 7200),
+            _row('shared', 'app1', 'broker-authorization-shared', 7200),
+            _row('nosecret', 'app1', 'broker-authorization-nosecret', 7200),
+            _row('recent', 'app1', 'broker-authorization-recent', 60)]}]
+        self.dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+
+    def _reconcile(self, event):
+        with mock.patch('webhook._get_kube_config'), \
+                mock.patch('kubernetes.client.CoreV1Api', return_value=self.v1), \
+                mock.patch('clients.get_client', return_value=self.dynamo):
+            return index.handler(event, None)
+
+    def test_removes_orphans(self):
+        result = self._reconcile({'reconcile': {}})['reconcile']
+
+        self.assertEqual(result['secrets'], 5)
+        self.assertEqual(result['orphaned_secrets'], 2)
+        self.assertEqual(result['orphaned_authorizations'], 2)
+        self.assertEqual(result['failed_authorizations'], 0)
+        removed = sorted(call[0][0] for call in self.v1.delete_namespaced_secret.call_args_list)
+        self.assertEqual(removed, ['broker-authorization-norow', 'broker-authorization-podgone'])
+        deleted = [request['DeleteRequest']['Key']['auth_token']['S']
+                   for request in self.dynamo.batch_write_item.call_args[1]['RequestItems']['role_perms']]
+        self.assertEqual(sorted(deleted), ['nosecret', 'podgone'])
+
+    def test_dry_run(self):
+        result = self._reconcile({'reconcile': {'dry_run': True}})['reconcile']
+
+        self.assertEqual(result['orphaned_secrets'], 2)
+        self.v1.delete_namespaced_secret.assert_not_called()
+        self.dynamo.batch_write_item.assert_not_called()
+
+    def test_unprocessed_items_are_retried(self):
+        unprocessed = {'role_perms': [{'DeleteRequest': {'Key': {'auth_token': {'S': 'a'}}}}]}
+        self.dynamo.batch_write_item.side_effect = [{'UnprocessedItems': unprocessed}, {'UnprocessedItems': {}}]
+        with mock.patch('clients.get_client', return_value=self.dynamo), mock.patch('time.sleep'):
+            self.assertEqual(reconcile._delete_authorizations(['a', 'b']), 0)
+        self.assertEqual(self.dynamo.batch_write_item.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+from unittest import mock
+
+import resilience
+
+from botocore.exceptions import ClientError
+
+
+def _error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'GetItem')
+
+
+class TestResilienceCase(unittest.TestCase):
+
+    def test_retries_throttling_and_unavailable_only(self):
+        breaker = resilience.CircuitBreaker('test', failure_threshold=10)
+        function = mock.Mock(side_effect=[_error('ProvisionedThroughputExceededException'), 'ok'])
+        with mock.patch('time.sleep') as sleep:
+            self.assertEqual(resilience.call(breaker, function, 1, key='value'), 'ok')
+        function.assert_called_with(1, key='value')
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(breaker.failures, 0)
+
+        # Every attempt counts towards the breaker
+        function = mock.Mock(side_effect=_error('ServiceUnavailable'))
+        with mock.patch('time.sleep'), self.assertRaises(ClientError):
+            resilience.call(breaker, function)
+        self.assertEqual(function.call_count, 3)
+        self.assertEqual(breaker.failures, 3)
+        breaker.record_success()
+
+        function = mock.Mock(side_effect=_error('AccessDenied'))
+        with self.assertRaises(ClientError):
+            resilience.call(breaker, function)
+        self.assertEqual(function.call_count, 1)
+        self.assertEqual(breaker.state, resilience.CLOSED)
+
+    def test_breaker_transitions(self):
+        breaker = resilience.CircuitBreaker('test', failure_threshold=2, reset_seconds=30)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, resilience.OPEN)
+
+        with self.assertRaises(resilience.CircuitOpen) as raised:
+            breaker.before_call()
+        self.assertGreater(raised.exception.retry_after, 29)
+
+        # Only one trial call once the reset period is over
+        breaker._opened_at -= 31
+        breaker.before_call()
+        self.assertEqual(breaker.state, resilience.HALF_OPEN)
+        with self.assertRaises(resilience.CircuitOpen):
+            breaker.before_call()
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, resilience.CLOSED)
+        breaker.before_call()
+
+    def test_backoff_is_capped(self):
+        with mock.patch.dict('os.environ', {'THROTTLE_BACKOFF_BASE_MS': '100', 'THROTTLE_BACKOFF_MAX_MS': '300'}):
+            self.assertTrue(all(0 <= resilience._backoff(10) <= 0.3 for _ in range(100)))
+
+
+if __name__ == '__main__':
+    unittest.main()
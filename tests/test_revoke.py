@@ -0,0 +1,87 @@
+import unittest
+from unittest import mock
+
+import index
+import revoke
+
+
+class TestRevokeCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dynamo = mock.Mock()
+        self.dynamo.get_paginator.return_value.paginate.side_effect = self._pages
+        self.dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+
+    def _pages(self, TableName, **kwargs):
+        if TableName == 'mapped_roles':
+            return [{'Items': [{'namespace': {'S': 'app1'}, 'service_account': {'S': 'default'}},
+                               {'namespace': {'S': 'app1'}, 'service_account': {'S': 'batch'}}]}]
+        return [{'Items': [{'auth_token': {'S': 'a'}}, {'auth_token': {'S': 'b'}}]},
+                {'Items': [{'auth_token': {'S': 'c'}}]}]
+
+    def _queries(self):
+        return [call[1] for call in self.dynamo.get_paginator.return_value.paginate.call_args_list
+                if call[1]['TableName'] == 'role_perms']
+
+    def _bumped(self):
+        return [(call[1]['Key']['namespace']['S'], call[1]['Key']['service_account']['S'])
+                for call in self.dynamo.update_item.call_args_list]
+
+    def _revoke(self, options):
+        with mock.patch('clients.get_client', return_value=self.dynamo):
+            return index.handler({'revoke': options}, None)['revoke']
+
+    def test_revoke_service_account(self):
+        result = self._revoke({'namespace': 'app1', 'service_account': 'default'})
+
+        self.assertEqual(result['authorizations'], 3)
+        self.assertEqual(result['failed_authorizations'], 0)
+        self.dynamo.get_paginator.assert_called_with('query')
+        query = self._queries()[0]
+        self.assertEqual(query['IndexName'], 'namespace-service_account-index')
+        self.assertEqual(query['KeyConditionExpression'], '#n = :namespace AND service_account = :service_account')
+        self.assertEqual(query['ExpressionAttributeValues'],
+                         {':namespace': {'S': 'app1'}, ':service_account': {'S': 'default'}})
+        deleted = [request['DeleteRequest']['Key']['auth_token']['S']
+                   for request in self.dynamo.batch_write_item.call_args[1]['RequestItems']['role_perms']]
+        self.assertEqual(deleted, ['a', 'b', 'c'])
+        # The shared Secrets of the service account are named after its allowance's generation
+        self.assertEqual(self._bumped(), [('app1', 'default')])
+        self.assertEqual(self.dynamo.update_item.call_args[1]['UpdateExpression'], 'ADD generation :one')
+
+    def test_revoke_role(self):
+        self._revoke({'role_arn': 'arn:aws:iam::123456789012:role/app'})
+
+        query = self._queries()[0]
+        self.assertEqual(query['IndexName'], 'role_arn-index')
+        self.assertNotIn('FilterExpression', query)
+        self.dynamo.get_paginator.assert_called_with('scan')
+        self.assertEqual(self._bumped(), [('app1', 'default'), ('app1', 'batch')])
+
+    def test_revoke_role_in_namespace(self):
+        self._revoke({'namespace': 'app1', 'role_arn': 'arn:aws:iam::123456789012:role/app'})
+
+        query = self._queries()[0]
+        self.assertEqual(query['IndexName'], 'namespace-service_account-index')
+        self.assertEqual(query['FilterExpression'], 'role_arn = :role_arn')
+        allowances = self.dynamo.get_paginator.return_value.paginate.call_args[1]
+        self.assertEqual(allowances['FilterExpression'], 'contains(allowed_roles, :role_arn)')
+        self.assertEqual(len(self._bumped()), 2)
+
+    def test_dry_run(self):
+        result = self._revoke({'namespace': 'app1', 'dry_run': True})
+
+        self.assertEqual(result['authorizations'], 3)
+        self.dynamo.batch_write_item.assert_not_called()
+        self.dynamo.update_item.assert_not_called()
+
+    def test_invalid(self):
+        self.assertIn('error', self._revoke({'service_account': 'default'}))
+        self.assertIn('error', self._revoke({}))
+        with self.assertRaises(ValueError):
+            revoke.revoke(service_account='default')
+        self.dynamo.get_paginator.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
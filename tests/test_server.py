@@ -0,0 +1,62 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import server
+
+
+async def _request(reader, writer, method, path, headers=None, body=b''):
+    lines = ['%s %s HTTP/1.1' % (method, path), 'Host: localhost', 'Content-Length: %d' % len(body)]
+    lines += ['%s: %s' % header for header in (headers or {}).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    response_headers = {}
+    while True:
+        line = (await reader.readline()).decode('latin-1').strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        response_headers[name] = value.strip()
+    return status, response_headers, await reader.readexactly(int(response_headers['Content-Length']))
+
+
+class TestServerCase(unittest.TestCase):
+
+    def test_keep_alive_requests(self):
+        async def scenario():
+            instance = server.Server()
+            await instance.start(host='127.0.0.1', port=0)
+            reader, writer = await asyncio.open_connection('127.0.0.1', instance.ports()[0])
+
+            health = await _request(reader, writer, 'GET', '/healthz')
+            unauthorized = await _request(reader, writer, 'GET', '/')
+            with mock.patch('webhook.handler', return_value={'statusCode': 200, 'headers': {},
+                                                             'body': json.dumps({'kind': 'AdmissionReview'})}) as hook:
+                admission = await _request(reader, writer, 'POST', '/', body=b'{}')
+
+            writer.close()
+            await instance.shutdown()
+            return health, unauthorized, admission, hook.call_args[0][0]
+
+        with mock.patch.dict('os.environ', {'APP_METRICS': 'false'}):
+            health, unauthorized, admission, event = asyncio.run(scenario())
+
+        self.assertEqual(health[0], 200)
+        self.assertEqual(unauthorized[0], 401)
+        self.assertEqual(unauthorized[1]['Connection'], 'keep-alive')
+        self.assertIn(b'Not Authorized', unauthorized[2])
+        self.assertEqual(admission[0], 200)
+        self.assertEqual(event['httpMethod'], 'POST')
+        self.assertEqual(event['body'], '{}')
+        self.assertEqual(event['requestContext']['identity']['sourceIp'], '127.0.0.1')
+
+    def test_canonical_header_names(self):
+        self.assertEqual(server._canonical('authorization'), 'Authorization')
+        self.assertEqual(server._canonical('content-TYPE'), 'Content-Type')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,17 @@
+import concurrent.futures
+import json
+import threading
+import time
 import unittest
+from unittest import mock
+
 import jsonpatch
 import webhook
 
+from botocore.exceptions import ClientError
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import MaxRetryError
+
 
 class TestWebhookCase(unittest.TestCase):
 
@@ -81,6 +91,343 @@ class TestWebhookCase(unittest.TestCase):
         self.assertIsNotNone(original['spec']['containers'][1]['env'])
         print(patch.to_string())
 
+    def test_build_patch_matches_diff(self):
+
+        original = {
+            'kind': 'Pod',
+            'apiVersion': 'v1',
+            'spec': {
+                'initContainers': [{'name': 'init', 'image': 'busybox'}],
+                'containers': [{
+                    'name': 'with-env',
+                    'image': 'quay.io/cuppett/aws-cli',
+                    'env': [{'name': 'AWS_REGION', 'value': 'us-east-2'}]
+                }, {
+                    'name': 'without-env',
+                    'image': 'quay.io/cuppett/aws-cli'
+                }],
+                'serviceAccountName': 'default'
+            }
+        }
+
+        expected = webhook._update_pod_spec(original, 'test_secret')
+        patched = jsonpatch.apply_patch(original, webhook._build_patch(original, 'test_secret'))
+
+        self.assertEqual(patched, expected)
+        self.assertEqual(len(patched['spec']['containers'][0]['env']), 3)
+        self.assertEqual(patched['spec']['containers'][0]['env'][0]['name'], 'AWS_REGION')
+        self.assertEqual(patched['spec']['initContainers'], original['spec']['initContainers'])
+        self.assertNotIn('env', original['spec']['containers'][1])
+
+    def test_node_agent_injection(self):
+        original = {'spec': {'containers': [{'name': 'app', 'env': [{'name': 'AWS_REGION', 'value': 'us-east-2'}]}]}}
+
+        with mock.patch.dict('os.environ', {'INJECTION_MODE': 'node',
+                                            'AGENT_URI': 'http://$(OCP_BROKER_NODE_IP):53080/'}):
+            expected = webhook._update_pod_spec(original, 'test_secret')
+            patched = jsonpatch.apply_patch(original, webhook._build_patch(original, 'test_secret'))
+
+        self.assertEqual(patched, expected)
+        self.assertEqual(len(patched['spec']['containers']), 1)
+        env = patched['spec']['containers'][0]['env']
+        self.assertEqual([variable['name'] for variable in env], [
+            'AWS_REGION', 'OCP_BROKER_NODE_IP', 'AWS_CONTAINER_CREDENTIALS_FULL_URI', 'AWS_CONTAINER_AUTHORIZATION_TOKEN'])
+        self.assertEqual(env[1]['valueFrom'], {'fieldRef': {'fieldPath': 'status.hostIP'}})
+        self.assertEqual(env[2]['value'], 'http://$(OCP_BROKER_NODE_IP):53080/')
+
+    def test_service_account_cache(self):
+        webhook._sa_annotation_cache.clear()
+        annotated = mock.Mock()
+        annotated.metadata.annotations = {'eks.amazonaws.com/role-arn': 'arn:aws:iam::111111111111:role/test'}
+        v1 = mock.Mock()
+
+        with mock.patch('webhook._get_kube_config'), mock.patch('kubernetes.client.CoreV1Api', return_value=v1):
+            v1.read_namespaced_service_account.return_value = annotated
+            self.assertEqual(webhook._identify_target_arn('app1', 'app-sa'), 'arn:aws:iam::111111111111:role/test')
+            self.assertEqual(webhook._identify_target_arn('app1', 'app-sa'), 'arn:aws:iam::111111111111:role/test')
+
+            v1.read_namespaced_service_account.side_effect = ApiException(status=404)
+            self.assertIsNone(webhook._identify_target_arn('app1', 'missing'))
+            self.assertIsNone(webhook._identify_target_arn('app1', 'missing'))
+
+        self.assertEqual(v1.read_namespaced_service_account.call_count, 2)
+
+    def test_service_account_concurrent_misses_read_once(self):
+        webhook._sa_annotation_cache.clear()
+        self.addCleanup(webhook._sa_annotation_cache.clear)
+        annotated = mock.Mock()
+        annotated.metadata.annotations = {'eks.amazonaws.com/role-arn': 'arn:aws:iam::111111111111:role/test'}
+        started = threading.Event()
+        release = threading.Event()
+
+        def read_service_account(name, namespace):
+            started.set()
+            release.wait(5)
+            return annotated
+
+        v1 = mock.Mock()
+        v1.read_namespaced_service_account.side_effect = read_service_account
+        with mock.patch('webhook._get_kube_config'), mock.patch('kubernetes.client.CoreV1Api', return_value=v1), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            leader = executor.submit(webhook._identify_target_arn, 'app1', 'app-sa')
+            started.wait(5)
+            followers = [executor.submit(webhook._identify_target_arn, 'app1', 'app-sa') for _ in range(7)]
+            time.sleep(0.05)
+            release.set()
+            results = [leader.result()] + [follower.result() for follower in followers]
+
+        self.assertEqual(set(results), {'arn:aws:iam::111111111111:role/test'})
+        self.assertEqual(v1.read_namespaced_service_account.call_count, 1)
+        self.assertEqual(webhook._sa_reads, {})
+
+    def test_service_account_watch_events(self):
+        webhook._sa_annotation_cache.clear()
+        service_account = mock.Mock()
+        service_account.metadata.namespace = 'app1'
+        service_account.metadata.name = 'app-sa'
+        service_account.metadata.annotations = {'eks.amazonaws.com/role-arn': 'arn:aws:iam::111111111111:role/test'}
+
+        webhook._apply_service_account_event('ADDED', service_account)
+        self.assertEqual(webhook._identify_target_arn('app1', 'app-sa'), 'arn:aws:iam::111111111111:role/test')
+        webhook._apply_service_account_event('DELETED', service_account)
+        self.assertIsNone(webhook._identify_target_arn('app1', 'app-sa'))
+
+    def test_shared_auth_secret(self):
+        webhook._shared_secrets.clear()
+        self.addCleanup(webhook._shared_secrets.clear)
+        v1 = mock.Mock()
+        dynamo = mock.Mock()
+        role = 'arn:aws:iam::111111111111:role/test'
+
+        def admit(allowance):
+            with mock.patch.dict('os.environ', {'SHARE_AUTHORIZATIONS': 'true'}), \
+                    mock.patch('webhook._get_kube_config'), \
+                    mock.patch('kubernetes.client.CoreV1Api', return_value=v1), \
+                    mock.patch('clients.get_client', return_value=dynamo), \
+                    mock.patch('webhook._get_allowance', return_value=allowance), \
+                    mock.patch('webhook._identify_target_arn', return_value=role):
+                return webhook._get_auth_secret('app1', 'app-sa')
+
+        first = admit({'allowed_roles': {'SS': [role]}})
+        second = admit({'allowed_roles': {'SS': [role]}})
+        self.assertTrue(first.startswith('broker-authorization-'))
+        self.assertEqual(first, second)
+        self.assertEqual(v1.create_namespaced_secret.call_count, 1)
+        # The row goes in ahead of the Secret
+        self.assertEqual(dynamo.put_item.call_count, 1)
+
+        # Another instance already minted this period's Secret: its row is refreshed (never recreated) and ours undone
+        webhook._shared_secrets.clear()
+        v1.create_namespaced_secret.side_effect = ApiException(status=409)
+        v1.read_namespaced_secret.return_value.data = {'AWS_CONTAINER_AUTHORIZATION_TOKEN': 'dG9rZW4='}
+        self.assertEqual(admit({'allowed_roles': {'SS': [role]}}), first)
+        self.assertEqual(dynamo.update_item.call_args[1]['Key'], {'auth_token': {'S': 'token'}})
+        self.assertEqual(dynamo.update_item.call_args[1]['ConditionExpression'], 'attribute_exists(auth_token)')
+        self.assertEqual(dynamo.delete_item.call_count, 1)
+
+        # After a revocation bumped the allowance's generation, every instance moves on to a new Secret
+        webhook._shared_secrets.clear()
+        v1.create_namespaced_secret.side_effect = None
+        revoked = admit({'allowed_roles': {'SS': [role]}, 'generation': {'N': '1'}})
+        self.assertTrue(revoked.startswith('broker-authorization-'))
+        self.assertNotEqual(revoked, first)
+
+    def test_shared_secret_of_revoked_token_not_revived(self):
+        # An instance whose Allowances index has not seen the revocation's generation yet
+        webhook._shared_secrets.clear()
+        self.addCleanup(webhook._shared_secrets.clear)
+        role = 'arn:aws:iam::111111111111:role/test'
+        v1 = mock.Mock()
+        v1.create_namespaced_secret.side_effect = [ApiException(status=409), None]
+        v1.read_namespaced_secret.return_value.data = {'AWS_CONTAINER_AUTHORIZATION_TOKEN': 'cmV2b2tlZA=='}
+        dynamo = mock.Mock()
+        dynamo.update_item.side_effect = ClientError(
+            {'Error': {'Code': 'ConditionalCheckFailedException', 'Message': 'gone'}}, 'UpdateItem')
+
+        with mock.patch('webhook._get_kube_config'), \
+                mock.patch('kubernetes.client.CoreV1Api', return_value=v1), \
+                mock.patch('clients.get_client', return_value=dynamo):
+            secret_name = webhook._get_shared_auth_secret('app1', 'app-sa', role)
+
+        stale_name = v1.read_namespaced_secret.call_args[0][0]
+        self.assertNotEqual(secret_name, stale_name)
+        self.assertEqual(v1.create_namespaced_secret.call_args[0][1]['metadata']['name'], secret_name)
+        inserted = [call[1]['Item']['auth_token']['S'] for call in dynamo.put_item.call_args_list]
+        self.assertNotIn('revoked', inserted)
+        self.assertEqual(len(inserted), 2)
+
+    def test_allowed_duration(self):
+        role = 'arn:aws:iam::111111111111:role/test'
+        allowance = {'allowed_roles': {'SS': [role]}, 'duration': {'N': '1800'},
+                     'role_durations': {'M': {'arn:aws:iam::111111111111:role/other': {'N': '3600'}}}}
+        self.assertEqual(webhook._allowed_duration(allowance, role), 1800)
+        self.assertEqual(webhook._allowed_duration(allowance, 'arn:aws:iam::111111111111:role/other'), 3600)
+        self.assertIsNone(webhook._allowed_duration({'allowed_roles': {'SS': [role]}}, role))
+
+        dynamo = mock.Mock()
+        with mock.patch('clients.get_client', return_value=dynamo):
+            webhook._insert_auth_row('token', role, 'secret', 'app1', 'app-sa', 1800)
+        self.assertEqual(dynamo.put_item.call_args[1]['Item']['duration'], {'N': '1800'})
+
+    def test_auth_secret_unwinds_row(self):
+        role = 'arn:aws:iam::111111111111:role/test'
+
+        # The Secret is refused by the API server, or its creation raises (e.g. the API server is unreachable)
+        for create_secret in [{'return_value': None},
+                              {'side_effect': MaxRetryError(None, '/api/v1/namespaces/app1/secrets')}]:
+            dynamo = mock.Mock()
+            with mock.patch.dict('os.environ', {'ALLOWANCES_MAX_STALENESS': '0'}), \
+                    mock.patch('clients.get_client', return_value=dynamo), \
+                    mock.patch('webhook._get_allowance', return_value={'allowed_roles': {'SS': [role]}}), \
+                    mock.patch('webhook._identify_target_arn', return_value=role), \
+                    mock.patch('webhook._create_secret', **create_secret):
+                self.assertIsNone(webhook._get_auth_secret('app1', 'app-sa'))
+
+            dynamo.put_item.assert_called_once()
+            auth_token = dynamo.put_item.call_args[1]['Item']['auth_token']
+            self.assertEqual(dynamo.delete_item.call_args[1]['Key'], {'auth_token': auth_token})
+
+    def test_kube_config_reloads(self):
+        self.addCleanup(setattr, webhook, 'kube_init', False)
+        self.addCleanup(setattr, webhook, '_api_client', None)
+        loads = []
+
+        def load():
+            configuration = mock.Mock()
+            loads.append(configuration)
+            return configuration
+
+        with mock.patch('webhook._load_kube_configuration', side_effect=load), \
+                mock.patch('kubernetes.client.Configuration.set_default'), \
+                mock.patch('kubernetes.client.ApiClient', side_effect=lambda configuration: mock.Mock()), \
+                mock.patch.dict('os.environ', {'KUBECONFIG_TTL': '60'}):
+            webhook.kube_init = False
+            webhook._get_kube_config()
+            first = webhook._api_client
+            webhook._get_kube_config()
+            self.assertIs(webhook._api_client, first)
+            self.assertEqual(len(loads), 1)
+
+            # Expired
+            webhook._kube_loaded_at -= 61
+            webhook._get_kube_config()
+            self.assertIsNot(webhook._api_client, first)
+            self.assertEqual(len(loads), 2)
+
+            # Unauthorized, only the first caller refused with the current client reloads
+            second = webhook._api_client
+            webhook._get_kube_config(stale_client=first)
+            self.assertEqual(len(loads), 2)
+            webhook._get_kube_config(stale_client=second)
+            self.assertEqual(len(loads), 3)
+
+    def test_unauthorized_retries_with_reloaded_client(self):
+        self.addCleanup(setattr, webhook, '_api_client', None)
+        refused = mock.Mock()
+        refused.read_namespaced_secret.side_effect = ApiException(status=401)
+        accepted = mock.Mock()
+        apis = {}
+
+        def reload(stale_client=None):
+            webhook._api_client = 'reloaded' if stale_client is not None else 'initial'
+
+        def core_api(api_client):
+            apis.setdefault(api_client, refused if api_client == 'initial' else accepted)
+            return apis[api_client]
+
+        with mock.patch('webhook._get_kube_config', side_effect=reload), \
+                mock.patch('kubernetes.client.CoreV1Api', side_effect=core_api):
+            v1 = webhook._core_api()
+            self.assertIs(v1.read_namespaced_secret('name', 'app1'), accepted.read_namespaced_secret.return_value)
+
+        refused.read_namespaced_secret.assert_called_once_with('name', 'app1')
+        accepted.read_namespaced_secret.assert_called_once_with('name', 'app1')
+
+    def test_skip_reasons(self):
+        def request(**changes):
+            request = {'uid': '1', 'kind': {'kind': 'Pod'}, 'operation': 'CREATE', 'namespace': 'app1',
+                       'object': {'spec': {'serviceAccountName': 'app-sa', 'containers': [{'name': 'app'}]}}}
+            request.update(changes)
+            return request
+
+        injected = request()
+        injected['object']['spec']['containers'].append({'name': 'ocp-broker-proxy'})
+        with mock.patch.dict('os.environ', {'ALLOWANCES_MAX_STALENESS': '0'}):
+            self.assertIsNone(webhook._skip_reason(request()))
+            self.assertEqual(webhook._skip_reason(request(kind={'kind': 'Secret'})), 'not_pod')
+            self.assertEqual(webhook._skip_reason(request(operation='UPDATE')), 'operation')
+            self.assertEqual(webhook._skip_reason(request(dryRun=True)), 'dry_run')
+            self.assertEqual(webhook._skip_reason(request(namespace='kube-system')), 'namespace')
+            self.assertEqual(webhook._skip_reason(request(namespace='openshift-monitoring')), 'namespace')
+            self.assertEqual(webhook._skip_reason(request(object={'spec': {'containers': []}})), 'no_service_account')
+            self.assertEqual(webhook._skip_reason(injected), 'already_injected')
+            injected = request()
+            injected['object']['spec']['containers'][0]['env'] = [{'name': 'AWS_CONTAINER_AUTHORIZATION_TOKEN'}]
+            self.assertEqual(webhook._skip_reason(injected), 'already_injected')
+            with mock.patch.dict('os.environ', {'NAMESPACE_INCLUDE': 'team-*'}):
+                self.assertEqual(webhook._skip_reason(request()), 'namespace')
+                self.assertIsNone(webhook._skip_reason(request(namespace='team-a')))
+
+    def test_skipped_admission_does_no_io(self):
+        event = {'body': '{"apiVersion": "admission.k8s.io/v1", "request": {"uid": "1", "kind": {"kind": "Pod"}, '
+                         '"operation": "CREATE", "namespace": "kube-system", "object": {"spec": {}}}}'}
+        with mock.patch('webhook._get_kube_config') as get_kube_config, \
+                mock.patch('clients.get_client') as get_client:
+            response = webhook.handler(event, None)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertIn('"patch": "W10="', response['body'])
+        get_kube_config.assert_not_called()
+        get_client.assert_not_called()
+
+        self.assertEqual(webhook.handler({'body': '{"request": {}}'}, None)['statusCode'], 400)
+        self.assertEqual(webhook.handler({'body': 'not json'}, None)['statusCode'], 400)
+
+    def test_delete_admission_releases_secret(self):
+        def pod(secret_name, metadata=None, node_name=None):
+            return {'metadata': metadata or {'name': 'pod'}, 'spec': {'nodeName': node_name, 'containers': [{
+                'name': 'app', 'env': [{
+                'name': 'AWS_CONTAINER_AUTHORIZATION_TOKEN',
+                'valueFrom': {'secretKeyRef': {'name': secret_name, 'key': 'AWS_CONTAINER_AUTHORIZATION_TOKEN'}}}]}]}}
+
+        def event(old_object, grace_period=None):
+            return {'body': json.dumps({'apiVersion': 'admission.k8s.io/v1', 'request': {
+                'uid': '1', 'kind': {'kind': 'Pod'}, 'operation': 'DELETE', 'namespace': 'app1',
+                'oldObject': old_object, 'options': {'kind': 'DeleteOptions', 'gracePeriodSeconds': grace_period}}})}
+
+        def read_secret(name, namespace):
+            if name == 'broker-authorization-gone':
+                raise ApiException(status=404)
+            labels = {'ocp-iam-broker/shared': 'true'} if name == 'broker-authorization-shared' else None
+            return mock.Mock(metadata=mock.Mock(labels=labels), data={'AWS_CONTAINER_AUTHORIZATION_TOKEN': 'dG9rZW4='})
+
+        v1 = mock.Mock()
+        v1.read_namespaced_secret.side_effect = read_secret
+        dynamo = mock.Mock()
+        dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+        with mock.patch('webhook._get_kube_config'), mock.patch('kubernetes.client.CoreV1Api', return_value=v1), \
+                mock.patch('clients.get_client', return_value=dynamo):
+            # Graceful DELETE of a running pod: nothing is released until the kubelet's final DELETE
+            webhook.handler(event(pod('broker-authorization-abc', node_name='node1'), 30), None)
+            # Nor is it on a repeated graceful DELETE of the terminating pod (e.g. kubectl delete run twice)
+            terminating = {'name': 'pod', 'deletionTimestamp': '2024-01-01T00:00:00Z'}
+            webhook.handler(event(pod('broker-authorization-abc', node_name='node1', metadata=terminating), 30), None)
+            webhook.handler(event(pod('broker-authorization-abc', node_name='node1', metadata=terminating)), None)
+            dynamo.batch_write_item.assert_not_called()
+            response = webhook.handler(event(pod('broker-authorization-abc', node_name='node1', metadata=terminating),
+                                             0), None)
+            webhook.handler(event(pod('broker-authorization-gone')), None)
+            webhook.handler(event(pod('broker-authorization-shared')), None)
+            webhook.handler(event({'spec': {'containers': [{'name': 'app'}]}}), None)
+
+        self.assertEqual(json.loads(response['body'])['response'], {'uid': '1', 'allowed': True})
+        self.assertEqual(dynamo.batch_write_item.call_args[1]['RequestItems']['role_perms'],
+                         [{'DeleteRequest': {'Key': {'auth_token': {'S': 'token'}}}}])
+        self.assertEqual(dynamo.batch_write_item.call_count, 1)
+        removed = [call[0][0] for call in v1.delete_namespaced_secret.call_args_list]
+        self.assertEqual(removed, ['broker-authorization-abc'])
+        self.assertEqual(v1.read_namespaced_secret.call_count, 3)
+
 
 if __name__ == '__main__':
     unittest.main()
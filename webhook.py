@@ -9,97 +9,303 @@
   permissions and limitations under the License.
 """
 
+import allowances
 import base64
-import boto3
+import cache
+import clients
+import concurrent.futures
+import contextvars
 import copy
 import datetime
+import fnmatch
+import functools
+import hashlib
 import json
-import jsonpatch
 import kubernetes
 import logging
 import math
+import metrics
 import os
+import queue
 import random
 import string
+import threading
+import time
 import yaml
 
-from kubernetes import client, config
+from botocore.exceptions import ClientError
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
 
 _EMPTY_PATCHSET = 'W10='
+_SECRET_PREFIX = 'broker-authorization-'
+_SHARED_LABEL = 'ocp-iam-broker/shared'
+_BATCH_SIZE = 25
+_BATCH_ATTEMPTS = 5
+_PROXY_CONTAINER = 'ocp-broker-proxy'
 
 _logger = logging.getLogger()
 _logger.setLevel(logging.DEBUG if os.getenv('APP_DEBUG', '') == 'true' else logging.INFO)
 
 kube_init = False
 
+# ServiceAccount ARN annotations keyed by (namespace, service_account). A cached None means the ServiceAccount is
+# missing or has no annotation.
+_NOT_CACHED = object()
+_sa_annotation_cache = cache.LRUCache(int(os.getenv('SA_CACHE_SIZE', 4096)), ttl=float(os.getenv('SA_CACHE_TTL', 30)))
+_sa_watch_thread = None
+_pod_watch_threads = None
 
-def _get_kube_config() -> None:
-    """Will populate this Lambda with the value of the SSM parameter for kubeconfig"""
-    global kube_init
-    if not kube_init:
-        ssm_client = boto3.client('ssm')
+# ServiceAccount reads in flight, so concurrent misses for a key wait on a single read rather than each making one.
+_sa_reads = {}
+_sa_reads_lock = threading.Lock()
+
+# Shared authorization Secrets (SHARE_AUTHORIZATIONS) keyed by (namespace, service_account, role_arn, generation), each
+# kept for SHARED_SECRET_CACHE_TTL seconds at most (and not past the end of its rotation period).
+_shared_secrets = cache.LRUCache(int(os.getenv('SHARED_SECRET_CACHE_SIZE', 4096)))
+
+# Runs the independent DynamoDB & Kubernetes calls of an admission side by side.
+_admission_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.getenv('ADMISSION_CONCURRENCY', 16)),
+                                                            thread_name_prefix='admission')
+
+
+# Shared ApiClient (one urllib3 pool to the API server) built from the kubeconfig. Replaced as a whole when the
+# kubeconfig is reloaded, requests in flight keep using the client they started with.
+_api_client = None
+_kube_loaded_at = None
+_kube_lock = threading.Lock()
+
+
+def _load_kube_configuration() -> client.Configuration:
+    """Reads the kubeconfig from the SSM parameter (or, when KUBECONFIG_SOURCE is 'incluster', the ServiceAccount of
+    the pod running the webhook)"""
+    config_object = kubernetes.client.Configuration()
+    if os.getenv('KUBECONFIG_SOURCE', 'ssm') == 'incluster':
+        config.load_incluster_config(client_configuration=config_object)
+    else:
+        ssm_client = clients.get_client('ssm')
         kubeconfig = ssm_client.get_parameter(Name=os.getenv('KUBECONFIG', 'WEBHOOK_KUBECONFIG'), WithDecryption=True)
         config_dict = yaml.safe_load(kubeconfig['Parameter']['Value'])
         loader = kubernetes.config.kube_config.KubeConfigLoader(config_dict)
-        config_object = kubernetes.client.Configuration()
         loader.load_and_set(config_object)
+    config_object.connection_pool_maxsize = int(os.getenv('KUBE_POOL_MAXSIZE', 16))
+    config_object.keep_alive = os.getenv('KUBE_TCP_KEEPALIVE', 'true') == 'true'
+    return config_object
+
+
+@metrics.timed('get_kube_config')
+def _get_kube_config(stale_client: client.ApiClient = None) -> None:
+    """Will populate this Lambda with the kubeconfig, loading it again once older than KUBECONFIG_TTL seconds (0 never
+    reloads) or when stale_client, the client which was just refused, is still the current one."""
+    global _api_client, _kube_loaded_at, kube_init
+    ttl = float(os.getenv('KUBECONFIG_TTL', 3600))
+    with _kube_lock:
+        if kube_init and _api_client is not None and stale_client is not _api_client and \
+                (ttl <= 0 or time.monotonic() - _kube_loaded_at < ttl):
+            return
+        try:
+            config_object = _load_kube_configuration()
+        except Exception:
+            if _api_client is None:
+                raise
+            # Keeping the configuration already loaded, trying again in a minute
+            _logger.exception('Unable to reload the kubeconfig, keeping the current one')
+            _kube_loaded_at = time.monotonic() - max(0.0, ttl - 60)
+            return
         kubernetes.client.Configuration.set_default(config_object)
-    kube_init = True
+        _api_client, _kube_loaded_at, kube_init = client.ApiClient(config_object), time.monotonic(), True
 
 
-def _identify_target_arn(namespace: string, service_account: string) -> string:
-    """Will lookup the target ARN in Kubernetes via an annotation on the ServiceAccount.
-    If none is found, or there is an error, will return None."""
+class _CoreV1Api:
+    """CoreV1Api over the shared ApiClient. A 401 (e.g. a rotated token) reloads the kubeconfig and retries once."""
+
+    def __init__(self):
+        self._api_client = _api_client
+        self._api = client.CoreV1Api(self._api_client)
 
-    # Identifying the annotation to find. Using the default to match the EKS webhook
+    def __getattr__(self, name):
+        method = getattr(self._api, name)
+        if not callable(method):
+            return method
+
+        @functools.wraps(method)
+        def call(*args, **kwargs):
+            try:
+                return method(*args, **kwargs)
+            except ApiException as e:
+                if e.status != 401:
+                    raise
+                _logger.warning('Unauthorized by the Kubernetes API, reloading the kubeconfig')
+                _get_kube_config(stale_client=self._api_client)
+                self._api_client = _api_client
+                self._api = client.CoreV1Api(self._api_client)
+                return getattr(self._api, name)(*args, **kwargs)
+        return call
+
+
+def _core_api() -> _CoreV1Api:
+    _get_kube_config()
+    return _CoreV1Api()
+
+
+def _annotation_from(service_account) -> string:
     arn_annotation = os.getenv('ARN_ANNOTATION', 'eks.amazonaws.com/role-arn')
+    annotations = service_account.metadata.annotations
+    if annotations is not None and arn_annotation in annotations:
+        return annotations[arn_annotation]
+    return None
 
+
+@metrics.timed('identify_target_arn')
+def _identify_target_arn(namespace: string, service_account: string) -> string:
+    """Will lookup the target ARN in Kubernetes via an annotation on the ServiceAccount.
+    If none is found, or there is an error, will return None."""
+    key = (namespace, service_account)
+    with _sa_reads_lock:
+        cached = _sa_annotation_cache.get(key, _NOT_CACHED)
+        if cached is not _NOT_CACHED:
+            metrics.count('service_account_cache_hit')
+            return cached
+        read = _sa_reads.get(key)
+        leader = read is None
+        if leader:
+            read = _sa_reads[key] = concurrent.futures.Future()
+
+    if not leader:
+        metrics.count('service_account_read_coalesced')
+        return read.result()
+    try:
+        target_arn = _read_target_arn(namespace, service_account)
+        read.set_result(target_arn)
+        return target_arn
+    except BaseException as e:
+        read.set_exception(e)
+        raise
+    finally:
+        with _sa_reads_lock:
+            del _sa_reads[key]
+
+
+def _read_target_arn(namespace: string, service_account: string) -> string:
     # Retrieving the annotation
     try:
-        v1 = client.CoreV1Api()
+        v1 = _core_api()
 
         resp = v1.read_namespaced_service_account(service_account, namespace)
-        if resp.metadata.annotations is not None and arn_annotation in resp.metadata.annotations:
-            _logger.debug('Annotation found: ' + resp.metadata.annotations[arn_annotation])
-            return resp.metadata.annotations[arn_annotation]
+        target_arn = _annotation_from(resp)
+        if target_arn is not None:
+            _logger.debug('Annotation found: ' + target_arn)
         else:
+            # Identifying the annotation to find. Using the default to match the EKS webhook
             _logger.debug('No annotation %s found for namespace %s and serviceaccount %s',
-                          arn_annotation, namespace, service_account)
-            return None
+                          os.getenv('ARN_ANNOTATION', 'eks.amazonaws.com/role-arn'), namespace, service_account)
+        _sa_annotation_cache.put((namespace, service_account), target_arn)
+        return target_arn
     except ApiException as e:
         if (e.status != 404):
             _logger.error("Unknown error trying to fetch service account: %s" % e)
+        else:
+            _sa_annotation_cache.put((namespace, service_account), None)
         return None
 
 
+def _apply_service_account_event(event_type: string, service_account) -> None:
+    key = (service_account.metadata.namespace, service_account.metadata.name)
+    ttl = float(os.getenv('SA_WATCH_TTL', 600))
+    if event_type == 'DELETED':
+        _sa_annotation_cache.put(key, None, ttl=ttl)
+    elif event_type in ('ADDED', 'MODIFIED'):
+        _sa_annotation_cache.put(key, _annotation_from(service_account), ttl=ttl)
+
+
+def _list_service_accounts(v1) -> string:
+    """Lists (paginated) every ServiceAccount into the cache, returning the resourceVersion to watch from."""
+    continue_token = None
+    while True:
+        resp = v1.list_service_account_for_all_namespaces(limit=500, _continue=continue_token)
+        for service_account in resp.items:
+            _apply_service_account_event('ADDED', service_account)
+        continue_token = resp.metadata._continue
+        if not continue_token:
+            return resp.metadata.resource_version
+
+
+def _watch_service_accounts() -> None:
+    resource_version = None
+    while True:
+        try:
+            v1 = _core_api()
+            if resource_version is None:
+                resource_version = _list_service_accounts(v1)
+                _logger.info('ServiceAccount cache listed at resourceVersion %s', resource_version)
+
+            stream = watch.Watch().stream(v1.list_service_account_for_all_namespaces,
+                                          resource_version=resource_version, allow_watch_bookmarks=True,
+                                          timeout_seconds=300)
+            for event in stream:
+                if event['type'] != 'BOOKMARK':
+                    _apply_service_account_event(event['type'], event['object'])
+                resource_version = event['object'].metadata.resource_version
+        except ApiException as e:
+            if e.status == 410:
+                # Too old to resume, relisting
+                resource_version = None
+            else:
+                _logger.error('Unknown error watching service accounts: %s' % e)
+                time.sleep(5)
+        except Exception as e:
+            _logger.error('Unknown error watching service accounts: %s' % e)
+            time.sleep(5)
+
+
+def start_service_account_watch() -> None:
+    """Keeps the ServiceAccount annotation cache fresh from a list/watch of the cluster.
+    Only useful when the webhook runs in a long-lived process (a frozen Lambda would drop the watch)."""
+    global _sa_watch_thread
+    if _sa_watch_thread is None:
+        _get_kube_config()
+        _sa_watch_thread = threading.Thread(target=_watch_service_accounts, name='sa-watch', daemon=True)
+        _sa_watch_thread.start()
+
+
 def _delete_secret(namespace: string, name: string) -> None:
     try:
-        v1 = client.CoreV1Api()
+        v1 = _core_api()
         v1.delete_namespaced_secret(name, namespace)
         _logger.info("Secret %s removed in namespace %s", name, namespace)
     except ApiException as e:
         _logger.error("Unknown error removing secret: %s" % e)
 
 
-def _create_secret(namespace: string, auth_token: string) -> string:
-    try:
-        v1 = client.CoreV1Api()
-        secret_name = 'broker-authorization-' + \
-                      ''.join([random.choice(string.ascii_lowercase + string.digits) for n in range(32)])
-        secret = {
-            'apiVersion': 'v1',
-            'kind': 'Secret',
-            'metadata': {
-                'name': secret_name,
-                'namespace': namespace
-            },
-            'type': 'Opaque',
-            'stringData': {
-                'AWS_CONTAINER_AUTHORIZATION_TOKEN': auth_token
-            }
+def _secret_body(namespace: string, secret_name: string, auth_token: string, labels: {} = None) -> {}:
+    secret = {
+        'apiVersion': 'v1',
+        'kind': 'Secret',
+        'metadata': {
+            'name': secret_name,
+            'namespace': namespace
+        },
+        'type': 'Opaque',
+        'stringData': {
+            'AWS_CONTAINER_AUTHORIZATION_TOKEN': auth_token
         }
-        resp = v1.create_namespaced_secret(namespace, secret)
+    }
+    if labels is not None:
+        secret['metadata']['labels'] = labels
+    return secret
+
+
+def _new_secret_name() -> string:
+    return _SECRET_PREFIX + ''.join([random.choice(string.ascii_lowercase + string.digits) for n in range(32)])
+
+
+@metrics.timed('create_secret')
+def _create_secret(namespace: string, auth_token: string, secret_name: string = None) -> string:
+    try:
+        v1 = _core_api()
+        if secret_name is None:
+            secret_name = _new_secret_name()
+        resp = v1.create_namespaced_secret(namespace, _secret_body(namespace, secret_name, auth_token))
         _logger.debug('Result of the call: %s', resp)
         return secret_name
     except ApiException as e:
@@ -107,27 +313,55 @@ def _create_secret(namespace: string, auth_token: string) -> string:
         return None
 
 
-def _get_allowed_arns(namespace: string, service_account: string) -> []:
-    """Looks up the allowed ARNs from DynamoDB. We ensure this """
+@metrics.timed('get_allowed_arns')
+def _get_allowance(namespace: string, service_account: string) -> {}:
+    """Looks up the Allowances item from the in-memory Allowances index, or from DynamoDB directly when the index is
+    disabled or cannot be loaded."""
+    if allowances.enabled():
+        try:
+            return allowances.get_allowance(namespace, service_account)
+        except Exception as e:
+            _logger.error('Unable to load the Allowances index, querying the table: %s', e)
+
     try:
-        dynamo = boto3.client('dynamodb')
+        dynamo = clients.get_client('dynamodb')
         row = dynamo.get_item(TableName=os.getenv('MAP_TABLE', 'mapped_roles'),
                               Key={'namespace': {'S': namespace}, 'service_account':  {'S': service_account}})
         if row is not None and 'Item' in row:
-            return row['Item']['allowed_roles']['SS']
-        else:
-            _logger.debug('No allowed ARNs identified')
+            return row['Item']
     except Exception as e:
         _logger.error('Unknown error querying table: %s', e)
 
     return None
 
 
+def _allowed_arns(allowance: {}) -> []:
+    if allowance is not None and 'allowed_roles' in allowance:
+        return allowance['allowed_roles']['SS']
+    _logger.debug('No allowed ARNs identified')
+    return None
+
+
+def _get_allowed_arns(namespace: string, service_account: string) -> []:
+    return _allowed_arns(_get_allowance(namespace, service_account))
+
+
+def _allowed_duration(allowance: {}, role_arn: string) -> int:
+    """The STS session duration configured on the allowance for the role: a role_durations map entry (role ARN to
+    seconds) or the allowance-wide duration. None leaves it to the broker's DEFAULT_DURATION."""
+    if 'role_durations' in allowance and role_arn in allowance['role_durations']['M']:
+        return int(allowance['role_durations']['M'][role_arn]['N'])
+    if 'duration' in allowance:
+        return int(allowance['duration']['N'])
+    return None
+
+
+@metrics.timed('insert_auth_row')
 def _insert_auth_row(auth_token: string, role_arn: string, secret_name: string, namespace: string,
-                     service_account: string) -> None:
-    dynamo = boto3.client('dynamodb')
+                     service_account: string, duration: int = None) -> None:
+    dynamo = clients.get_client('dynamodb')
 
-    expires_days_in_seconds = os.getenv('EXPIRES_IN_DAYS', 14) * 86400
+    expires_days_in_seconds = int(os.getenv('EXPIRES_IN_DAYS', 14)) * 86400
     expires_ts = datetime.datetime.now() + datetime.timedelta(seconds=expires_days_in_seconds)
     expires_ttl = math.floor(expires_ts.timestamp())
 
@@ -151,66 +385,379 @@ def _insert_auth_row(auth_token: string, role_arn: string, secret_name: string,
             'N': str(expires_ttl)
         }
     }
+    if duration is not None:
+        item['duration'] = {'N': str(duration)}
 
     dynamo.put_item(TableName=os.getenv('AUTH_TABLE', 'role_perms'), Item=item)
 
 
+def _shared_rotation_seconds() -> int:
+    """Period after which a new shared token/Secret is minted. Kept under half the authorization TTL so a shared row
+    cannot expire while it is still being handed out."""
+    expires_days_in_seconds = int(os.getenv('EXPIRES_IN_DAYS', 14)) * 86400
+    return max(1, min(int(os.getenv('SHARED_TOKEN_ROTATION_SECONDS', 86400)), expires_days_in_seconds // 2))
+
+
+def _allowance_generation(allowance: {}) -> int:
+    """The allowance's generation, bumped by each revocation of its service account's authorizations."""
+    return int(allowance['generation']['N']) if 'generation' in allowance else 0
+
+
+def _refresh_auth_row(auth_token: string) -> bool:
+    """Pushes out the expiry of an existing row. Returns False, never recreating it, when the row is gone (revoked or
+    expired)."""
+    expires_days_in_seconds = int(os.getenv('EXPIRES_IN_DAYS', 14)) * 86400
+    expires_ts = datetime.datetime.now() + datetime.timedelta(seconds=expires_days_in_seconds)
+    try:
+        clients.get_client('dynamodb').update_item(
+            TableName=os.getenv('AUTH_TABLE', 'role_perms'),
+            Key={'auth_token': {'S': auth_token}},
+            UpdateExpression='set expires = :e',
+            ConditionExpression='attribute_exists(auth_token)',
+            ExpressionAttributeValues={':e': {'N': str(math.floor(expires_ts.timestamp()))}})
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def _claim_shared_secret(v1, namespace: string, service_account: string, target_arn: string, secret_name: string,
+                         duration: int = None) -> bool:
+    """Creates the shared Secret, inserting its row first so an existing Secret always has its row unless that was
+    revoked or expired. On a 409 adopts the Secret minted by another admission, returning False when its row is gone
+    rather than bringing a revoked token back. Other errors raise."""
+    auth_token = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(64)])
+    _insert_auth_row(auth_token, target_arn, secret_name, namespace, service_account, duration)
+    try:
+        with metrics.span('create_secret'):
+            v1.create_namespaced_secret(namespace, _secret_body(namespace, secret_name, auth_token,
+                                                                labels={_SHARED_LABEL: 'true'}))
+        return True
+    except Exception as e:
+        # Unwind the row, it is either unused or (409) superseded by the existing Secret's
+        _delete_auth_row(auth_token)
+        if not isinstance(e, ApiException) or e.status != 409:
+            raise
+
+    existing = v1.read_namespaced_secret(secret_name, namespace)
+    auth_token = base64.b64decode(existing.data['AWS_CONTAINER_AUTHORIZATION_TOKEN']).decode('utf-8')
+    return _refresh_auth_row(auth_token)
+
+
+def _get_shared_auth_secret(namespace: string, service_account: string, target_arn: string,
+                            duration: int = None, generation: int = 0) -> string:
+    """Returns the Secret shared by every pod of the service account assuming target_arn during the current rotation
+    period. The name is derived from the key, period and allowance generation, so concurrent admissions (on any
+    instance) converge on it, and a revocation moves every instance on to a new Secret."""
+    key = (namespace, service_account, target_arn, generation)
+    secret_name = _shared_secrets.get(key)
+    if secret_name is not None:
+        metrics.count('shared_secret_reused')
+        return secret_name
+
+    rotation = _shared_rotation_seconds()
+    now = time.time()
+    period = int(now // rotation)
+    parts = [namespace, service_account, target_arn, str(period)] + ([str(generation)] if generation > 0 else [])
+    secret_name = _SECRET_PREFIX + hashlib.sha256('/'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+    try:
+        v1 = _core_api()
+        if not _claim_shared_secret(v1, namespace, service_account, target_arn, secret_name, duration):
+            # e.g. this instance has not seen the generation bumped by a revocation yet
+            _logger.warning('Shared secret %s in namespace %s has no authorization left, minting another',
+                            secret_name, namespace)
+            metrics.count('shared_secret_revoked')
+            secret_name = _new_secret_name()
+            if not _claim_shared_secret(v1, namespace, service_account, target_arn, secret_name, duration):
+                return None
+    except Exception as e:
+        _logger.error("Unknown error minting shared secret: %s" % e)
+        return None
+
+    # Kept briefly, so a Secret removed meanwhile (e.g. by a reconcile) is created again on the next miss
+    _shared_secrets.put(key, secret_name, ttl=min((period + 1) * rotation - now,
+                                                  float(os.getenv('SHARED_SECRET_CACHE_TTL', 300))))
+    return secret_name
+
+
+def _submit(function, *args) -> concurrent.futures.Future:
+    """Runs the function on the admission pool, carrying over the caller's context (metrics spans)."""
+    return _admission_executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def _delete_auth_row(auth_token: string) -> None:
+    try:
+        clients.get_client('dynamodb').delete_item(TableName=os.getenv('AUTH_TABLE', 'role_perms'),
+                                                   Key={'auth_token': {'S': auth_token}})
+    except Exception as e:
+        _logger.error("Unknown error removing DynamoDB row: %s" % e)
+
+
 def _get_auth_secret(namespace: string, service_account: string) -> string:
 
     # Identify if there is a target ARN which is valid
-    arn_list = _get_allowed_arns(namespace, service_account)
     target_arn = None
-    if arn_list is not None and len(arn_list) > 0:
-        _logger.debug('List of ARNs: %s', arn_list)
-        target_arn = _identify_target_arn(namespace, service_account)
-        _logger.debug('Target ARN: %s', target_arn)
+    if allowances.enabled():
+        # Served from memory, so the ServiceAccount is only read when there is an allowance
+        allowance = _get_allowance(namespace, service_account)
+        arn_list = _allowed_arns(allowance)
+        if arn_list is not None and len(arn_list) > 0:
+            target_arn = _identify_target_arn(namespace, service_account)
+    else:
+        # The Allowances read and ServiceAccount read are independent, both are put in flight at once
+        target_arn_future = _submit(_identify_target_arn, namespace, service_account)
+        allowance = _get_allowance(namespace, service_account)
+        arn_list = _allowed_arns(allowance)
+        target_arn = target_arn_future.result()
+    _logger.debug('List of ARNs: %s', arn_list)
+    _logger.debug('Target ARN: %s', target_arn)
 
     # Setting up Kubernetes and DynamoDB with the needed Secret & row
-    if target_arn is not None and target_arn in arn_list:
+    if target_arn is not None and arn_list is not None and target_arn in arn_list:
+        duration = _allowed_duration(allowance, target_arn)
+        if os.getenv('SHARE_AUTHORIZATIONS', 'false') == 'true':
+            return _get_shared_auth_secret(namespace, service_account, target_arn, duration,
+                                           _allowance_generation(allowance))
+
         auth_token = ''.join([random.choice(string.ascii_letters + string.digits) for n in range(64)])
-        secret_name = _create_secret(namespace, auth_token)
+        secret_name = _new_secret_name()
 
-        # Insert the auth row into DynamoDB
-        if secret_name is not None:
-            try:
-                _insert_auth_row(auth_token, target_arn, secret_name, namespace, service_account)
-                return secret_name
-            except Exception as e:
-                _logger.error("Unknown error storing DynamoDB row: %s" % e)
-                # Unwind and remove the Kubernetes secret
-                _delete_secret(namespace, secret_name)
+        # Create the Secret and insert the auth row into DynamoDB side by side
+        secret_future = _submit(_create_secret, namespace, auth_token, secret_name)
+        try:
+            _insert_auth_row(auth_token, target_arn, secret_name, namespace, service_account, duration)
+            row_inserted = True
+        except Exception as e:
+            _logger.error("Unknown error storing DynamoDB row: %s" % e)
+            row_inserted = False
+        try:
+            secret_created = secret_future.result() is not None
+        except Exception as e:
+            # Not only ApiException: connection errors (urllib3) and kubeconfig failures surface here too
+            _logger.error("Unknown error generating secret: %s" % e)
+            secret_created = False
+
+        if secret_created and row_inserted:
+            return secret_name
+        elif secret_created:
+            # Unwind and remove the Kubernetes secret
+            _delete_secret(namespace, secret_name)
+        elif row_inserted:
+            # Unwind and remove the DynamoDB row
+            _delete_auth_row(auth_token)
 
     return None
 
 
-def remove_secret(namespace: string, secret_name: string) -> None:
-    _get_kube_config()
+def remove_secret(namespace: string, secret_name: string, v1: _CoreV1Api = None) -> bool:
+    """Deletes the Secret, returning whether it is gone (an already missing Secret counts as removed)."""
     try:
-        v1 = client.CoreV1Api()
+        if v1 is None:
+            v1 = _core_api()
         resp = v1.delete_namespaced_secret(secret_name, namespace)
         _logger.debug('Result of the call: %s', resp)
+        return True
     except ApiException as e:
+        if e.status == 404:
+            _logger.debug('Secret %s already removed from namespace %s', secret_name, namespace)
+            return True
+        _logger.error("Unknown error deleting secret: %s" % e)
+    except Exception as e:
         _logger.error("Unknown error deleting secret: %s" % e)
+    return False
 
 
-def _update_pod_spec(original: [], secret_name: string) -> []:
-    new = copy.deepcopy(original)
+def remove_secrets(secrets: []) -> []:
+    """Deletes the (namespace, secret_name) pairs with up to STREAM_CONCURRENCY requests in flight over one shared
+    client, returning the pairs which could not be removed."""
+    if len(secrets) == 0:
+        return []
+    v1 = _core_api()
+    workers = max(1, min(int(os.getenv('STREAM_CONCURRENCY', 8)), len(secrets)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda secret: remove_secret(secret[0], secret[1], v1), secrets)
+        return [secret for secret, removed in zip(secrets, results) if not removed]
 
-    # Add the secret & proxy environment variable to all the existing containers
-    for container in new['spec']['containers']:
-        if 'env' not in container:
-            container['env'] = []
-        container['env'].append({
-            'name': 'AWS_CONTAINER_CREDENTIALS_FULL_URI',
-            'value': 'http://127.0.0.1:' + os.getenv('PROXY_PORT', '53080')
-        })
-        container['env'].append({
-            'name': 'AWS_CONTAINER_AUTHORIZATION_TOKEN',
-            'valueFrom': {'secretKeyRef': {'name': secret_name, 'key': 'AWS_CONTAINER_AUTHORIZATION_TOKEN'}}
-        })
-    # Adding the proxy container to the pod spec
-    proxy_container = {
-        'name': 'ocp-broker-proxy',
+
+def delete_auth_rows(auth_tokens: [], concurrency: int = 4) -> []:
+    """Deletes the Authorizations rows in batches of 25 (batch_write_item) with up to concurrency batches in flight,
+    returning the tokens which could not be deleted. The stream REMOVE records then clean up any remaining Secret."""
+    table = os.getenv('AUTH_TABLE', 'role_perms')
+
+    def delete_batch(batch):
+        requests = [{'DeleteRequest': {'Key': {'auth_token': {'S': auth_token}}}} for auth_token in batch]
+        try:
+            for attempt in range(_BATCH_ATTEMPTS):
+                resp = clients.get_client('dynamodb').batch_write_item(RequestItems={table: requests})
+                requests = resp.get('UnprocessedItems', {}).get(table, [])
+                if len(requests) == 0:
+                    return []
+                time.sleep(0.05 * 2 ** attempt)
+        except Exception as e:
+            _logger.error('Unknown error removing DynamoDB rows: %s', e)
+        return [request['DeleteRequest']['Key']['auth_token']['S'] for request in requests]
+
+    if len(auth_tokens) == 0:
+        return []
+    batches = [auth_tokens[start:start + _BATCH_SIZE] for start in range(0, len(auth_tokens), _BATCH_SIZE)]
+    workers = max(1, min(concurrency, len(batches)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return [auth_token for failed in executor.map(delete_batch, batches) for auth_token in failed]
+
+
+def _field(value, name: string, attribute: string):
+    """Reads a field from either an API object as a dict (camelCase name) or a kubernetes client model (attribute)."""
+    return value.get(name) if isinstance(value, dict) else getattr(value, attribute, None)
+
+
+def _pod_secret_names(pod) -> []:
+    """The broker authorization Secrets referenced by the containers of a pod, given as a dict (e.g. an admission's
+    oldObject) or a V1Pod model (from a list or watch)."""
+    names = []
+    spec = _field(pod, 'spec', 'spec')
+    containers = (_field(spec, 'containers', 'containers') or []) + \
+        (_field(spec, 'initContainers', 'init_containers') or [])
+    for container in containers:
+        for env in _field(container, 'env', 'env') or []:
+            secret_ref = _field(_field(env, 'valueFrom', 'value_from'), 'secretKeyRef', 'secret_key_ref')
+            name = _field(secret_ref, 'name', 'name') or ''
+            if name.startswith(_SECRET_PREFIX) and name not in names:
+                names.append(name)
+    return names
+
+
+def release_secrets(secrets: []) -> []:
+    """Deletes the (namespace, secret_name) pairs of pods which are gone along with their Authorizations rows,
+    returning the pairs which could not be released. Shared Secrets are left to their rotation and the TTL, as other
+    pods may still use them. Secrets (or rows) already gone count as released."""
+    if len(secrets) == 0:
+        return []
+    v1 = _core_api()
+
+    def read_token(secret):
+        """Returns the pair, its token and whether to release it (None when gone already or shared)."""
+        try:
+            existing = v1.read_namespaced_secret(secret[1], secret[0])
+        except ApiException as e:
+            if e.status == 404:
+                return secret, None, None
+            _logger.error("Unknown error reading secret: %s" % e)
+            return secret, None, False
+        if _SHARED_LABEL in (existing.metadata.labels or {}):
+            return secret, None, None
+        token = (existing.data or {}).get('AWS_CONTAINER_AUTHORIZATION_TOKEN')
+        return secret, None if token is None else base64.b64decode(token).decode('utf-8'), True
+
+    workers = max(1, min(int(os.getenv('STREAM_CONCURRENCY', 8)), len(secrets)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        read = list(executor.map(read_token, secrets))
+    tokens = {secret: token for secret, token, release in read if release}
+    failed = [secret for secret, token, release in read if release is False]
+
+    # Rows first, a Secret whose row remains is left for the stream to remove once the row goes
+    failed_tokens = set(delete_auth_rows([token for token in tokens.values() if token is not None], workers))
+    removable = [secret for secret, token in tokens.items() if token not in failed_tokens]
+    failed.extend(secret for secret, token in tokens.items() if token in failed_tokens)
+    removal_failures = remove_secrets(removable)
+    failed.extend(removal_failures)
+    metrics.count('released_secrets', len(removable) - len(removal_failures))
+    return failed
+
+
+def _release_pod(namespace: string, pod: {}) -> None:
+    secrets = [(namespace, name) for name in _pod_secret_names(pod)]
+    failed = release_secrets(secrets)
+    if len(failed) > 0:
+        _logger.warning('Unable to release %s, leaving them to the TTL', failed)
+
+
+def _watch_deleted_pods(released: queue.Queue) -> None:
+    resource_version = None
+    while True:
+        try:
+            v1 = _core_api()
+            if resource_version is None:
+                resource_version = v1.list_pod_for_all_namespaces(limit=1).metadata.resource_version
+
+            stream = watch.Watch().stream(v1.list_pod_for_all_namespaces, resource_version=resource_version,
+                                          allow_watch_bookmarks=True, timeout_seconds=300)
+            for event in stream:
+                if event['type'] == 'DELETED':
+                    for name in _pod_secret_names(event['object']):
+                        released.put((event['object'].metadata.namespace, name))
+                resource_version = event['object'].metadata.resource_version
+        except ApiException as e:
+            if e.status == 410:
+                # Too old to resume, deletions missed meanwhile are left to the TTL (or a reconcile)
+                resource_version = None
+            else:
+                _logger.error('Unknown error watching pods: %s' % e)
+                time.sleep(5)
+        except Exception as e:
+            _logger.error('Unknown error watching pods: %s' % e)
+            time.sleep(5)
+
+
+def _release_batches(released: queue.Queue) -> None:
+    """Releases the Secrets of deleted pods in batches of up to POD_WATCH_BATCH_SIZE."""
+    batch_size = int(os.getenv('POD_WATCH_BATCH_SIZE', 100))
+    while True:
+        batch = [released.get()]
+        while len(batch) < batch_size:
+            try:
+                batch.append(released.get(timeout=float(os.getenv('POD_WATCH_BATCH_SECONDS', 1))))
+            except queue.Empty:
+                break
+        try:
+            failed = release_secrets(list(dict.fromkeys(batch)))
+            if len(failed) > 0:
+                _logger.warning('Unable to release %d secrets, leaving them to the TTL', len(failed))
+        except Exception as e:
+            _logger.error('Unknown error releasing secrets: %s' % e)
+
+
+def start_pod_watch() -> None:
+    """Releases the Secrets & rows of pods once they are deleted, from a watch of the cluster's pods. An alternative
+    to DELETE admissions, only useful when the webhook runs in a long-lived process."""
+    global _pod_watch_threads
+    if _pod_watch_threads is None:
+        _get_kube_config()
+        released = queue.Queue()
+        _pod_watch_threads = [
+            threading.Thread(target=_watch_deleted_pods, args=(released,), name='pod-watch', daemon=True),
+            threading.Thread(target=_release_batches, args=(released,), name='pod-release', daemon=True)
+        ]
+        for thread in _pod_watch_threads:
+            thread.start()
+
+
+def _node_agent() -> bool:
+    """In 'node' INJECTION_MODE pods use the credential agent (DaemonSet) on their node rather than a sidecar."""
+    return os.getenv('INJECTION_MODE', 'sidecar') == 'node'
+
+
+def _container_env(secret_name: string) -> []:
+    """The environment variables pointing a container at the proxy (or node agent) & its authorization Secret."""
+    env = []
+    if _node_agent():
+        # Defined ahead of the URI so AGENT_URI can reference it as $(OCP_BROKER_NODE_IP)
+        env.append({'name': 'OCP_BROKER_NODE_IP', 'valueFrom': {'fieldRef': {'fieldPath': 'status.hostIP'}}})
+        uri = os.getenv('AGENT_URI', 'http://169.254.170.2/')
+    else:
+        uri = 'http://127.0.0.1:' + os.getenv('PROXY_PORT', '53080')
+    env.append({'name': 'AWS_CONTAINER_CREDENTIALS_FULL_URI', 'value': uri})
+    env.append({
+        'name': 'AWS_CONTAINER_AUTHORIZATION_TOKEN',
+        'valueFrom': {'secretKeyRef': {'name': secret_name, 'key': 'AWS_CONTAINER_AUTHORIZATION_TOKEN'}}
+    })
+    return env
+
+
+def _proxy_container() -> {}:
+    return {
+        'name': _PROXY_CONTAINER,
         'image': os.getenv('PROXY_IMAGE',
                            'image-registry.openshift-image-registry.svc:5000/ocp-iam-broker/ocp-broker-proxy'),
         'resources': {
@@ -224,10 +771,38 @@ def _update_pod_spec(original: [], secret_name: string) -> []:
             }
         }
     }
-    new['spec']['containers'].append(proxy_container)
+
+
+def _update_pod_spec(original: [], secret_name: string) -> []:
+    new = copy.deepcopy(original)
+
+    # Add the secret & proxy environment variable to all the existing containers
+    for container in new['spec']['containers']:
+        if 'env' not in container:
+            container['env'] = []
+        container['env'].extend(_container_env(secret_name))
+    # Adding the proxy container to the pod spec
+    if not _node_agent():
+        new['spec']['containers'].append(_proxy_container())
     return new
 
 
+def _build_patch(original: [], secret_name: string) -> []:
+    """Emits the JSONPatch operations equivalent to diffing original against _update_pod_spec(original),
+    without copying or walking the rest of the pod."""
+    patch = []
+    for index, container in enumerate(original['spec']['containers']):
+        if 'env' in container:
+            for env in _container_env(secret_name):
+                patch.append({'op': 'add', 'path': '/spec/containers/%d/env/-' % index, 'value': env})
+        else:
+            patch.append({'op': 'add', 'path': '/spec/containers/%d/env' % index,
+                          'value': _container_env(secret_name)})
+    if not _node_agent():
+        patch.append({'op': 'add', 'path': '/spec/containers/-', 'value': _proxy_container()})
+    return patch
+
+
 def _generate_patchset(request_body: []) -> string:
     namespace = request_body['namespace']
     service_account = request_body['object']['spec']['serviceAccountName']
@@ -236,9 +811,8 @@ def _generate_patchset(request_body: []) -> string:
     # If we have an identified auth_token
     if auth_secret is not None:
         # Creating actual patch for insertion into response
-        new = _update_pod_spec(request_body['object'], auth_secret)
-        patch = jsonpatch.JsonPatch.from_diff(request_body['object'], new)
-        string_patch = patch.to_string()
+        with metrics.span('generate_patch'):
+            string_patch = json.dumps(_build_patch(request_body['object'], auth_secret))
         logging.debug('Patched Object: %s', string_patch)
         encodedBytes = base64.b64encode(string_patch.encode("utf-8"))
         encodedStr = str(encodedBytes, "utf-8")
@@ -250,36 +824,102 @@ def _generate_patchset(request_body: []) -> string:
         return _EMPTY_PATCHSET
 
 
+def _patterns(name: string, default: string) -> []:
+    return [pattern.strip() for pattern in os.getenv(name, default).split(',') if pattern.strip()]
+
+
+def _namespace_selected(namespace: string) -> bool:
+    """Matches the namespace against the NAMESPACE_INCLUDE (all when empty) & NAMESPACE_EXCLUDE patterns."""
+    include = _patterns('NAMESPACE_INCLUDE', '')
+    if len(include) > 0 and not any(fnmatch.fnmatchcase(namespace, pattern) for pattern in include):
+        return False
+    exclude = _patterns('NAMESPACE_EXCLUDE', 'kube-system,kube-public,kube-node-lease,openshift-*')
+    return not any(fnmatch.fnmatchcase(namespace, pattern) for pattern in exclude)
+
+
+def _skip_reason(request: {}) -> string:
+    """Identifies, without any I/O, admissions which cannot be mutated. Returns None when the pod needs a lookup."""
+    if request['kind'].get('kind') != 'Pod':
+        return 'not_pod'
+    operation = request.get('operation')
+    if operation != 'CREATE' and (operation != 'DELETE' or os.getenv('RELEASE_ON_DELETE', 'true') != 'true'):
+        return 'operation'
+    if request.get('dryRun', False):
+        # The Secret & row created (or released) for a pod are side effects
+        return 'dry_run'
+    namespace = request.get('namespace') or ''
+    if not _namespace_selected(namespace):
+        return 'namespace'
+    if operation == 'DELETE':
+        old_object = request.get('oldObject') or {}
+        # A graceful DELETE (the first one, or any repeated one) only marks a scheduled pod, its containers still run
+        # and use their credentials. Releasing waits for the final DELETE the kubelet sends with a zero grace period
+        # once they stopped, or for a pod which never reached a node.
+        if (request.get('options') or {}).get('gracePeriodSeconds') != 0 and \
+                (old_object.get('spec') or {}).get('nodeName'):
+            return 'graceful_delete'
+        return None if len(_pod_secret_names(old_object)) > 0 else 'no_secret'
+    spec = (request.get('object') or {}).get('spec') or {}
+    if not spec.get('serviceAccountName'):
+        return 'no_service_account'
+    for container in spec.get('containers') or []:
+        if container.get('name') == _PROXY_CONTAINER or \
+                any(env.get('name') == 'AWS_CONTAINER_AUTHORIZATION_TOKEN' for env in container.get('env') or []):
+            return 'already_injected'
+    if allowances.enabled() and allowances.loaded_namespace_has_allowances(namespace) is False:
+        return 'no_allowances'
+    return None
+
+
+def _bad_request(message: string) -> {}:
+    _logger.warning('Rejecting admission request: %s', message)
+    return {
+        'headers': {'Content-Type': 'application/json'},
+        'statusCode': 400,
+        'body': json.dumps({'message': message})
+    }
+
+
 def handler(event, context):
-    body = json.loads(event['body'])
+    try:
+        body = json.loads(event['body'])
+        request = body['request']
+        uid = request['uid']
+        skip_reason = _skip_reason(request)
+    except (KeyError, TypeError, AttributeError, ValueError) as e:
+        return _bad_request('Malformed AdmissionReview: %s' % e)
     patchset = _EMPTY_PATCHSET
 
-    if body['request']['kind']['kind'] == 'Pod':
+    if skip_reason is not None:
+        metrics.count('admission_skipped_' + skip_reason)
+        _logger.debug('Skipping admission %s: %s', uid, skip_reason)
+    else:
         try:
             _get_kube_config()
-            namespace = body['request']['namespace']
-            operation = body['request']['operation']
-
-            _logger.debug('Namespace: ' + namespace + ' Operation: ' + operation)
-
-            if operation == 'CREATE':
-                patchset = _generate_patchset(body['request'])
+            _logger.debug('Namespace: %s Operation: %s', request['namespace'], request['operation'])
+            if request['operation'] == 'DELETE':
+                _release_pod(request['namespace'], request['oldObject'])
+            else:
+                patchset = _generate_patchset(request)
 
         except Exception as e:
             _logger.error('Unhandled exception in webhook: %s', e)
 
+    response = {
+        "uid": uid,
+        "allowed": True
+    }
+    if request.get('operation') != 'DELETE':
+        response['patchType'] = 'JSONPatch'
+        response['patch'] = patchset
+
     to_return = {
         'headers': {'Content-Type': 'application/json'},
         'statusCode': 200,
         'body': json.dumps({
-            "apiVersion": body['apiVersion'],
+            "apiVersion": body.get('apiVersion', 'admission.k8s.io/v1'),
             "kind": "AdmissionReview",
-            "response": {
-                "uid": body['request']['uid'],
-                "allowed": True,
-                "patchType": "JSONPatch",
-                "patch": patchset
-            }
+            "response": response
         })
     }
 